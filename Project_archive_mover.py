@@ -17,7 +17,6 @@ finished by Phil Wilmarth, OHSU, 2013.
 import os
 import sys
 import shutil
-import filecmp
 import subprocess
 import platform
 import hashlib
@@ -25,6 +24,11 @@ import time
 import re
 import win32api
 
+from compare_tools import CompareEngine, DigestCache, TreeSnapshot, diff_snapshots, folder_digests
+from compare_tools import cached_digests, same_folders
+from compare_tools import tiered_cmp
+from copy_tools import copy_tree
+
 from tkinter import *
 from tkinter import filedialog
 ##from tkinter import messagebox    # not used?
@@ -44,6 +48,17 @@ FOLDER_NAMES = {'psrcore-mrba608': ('PSR_Core_Analysis', 'from_608'),
 
 ARCHIVE_NAME = 'zzz_TO_ARCHIVE'
 
+# saved file digests so unchanged project folders are not read again when compared
+# (kept in the same folder as this script)
+DIGEST_CACHE = 'Archive_mover_digests.db'
+# concurrent file reads on each side during folder comparisons
+READ_WORKERS = 4
+# how many times to rewrite a bad chunk of a copied file
+RETRY = 3
+
+# digest cache and comparison threads shared by all folder comparisons (see get_engine)
+ENGINE = None
+
 def no_hidden(files):
     """Removes files that start with periods.
     """
@@ -59,44 +74,71 @@ def print_error(log_file_list, error, left_path, right_path):
         print(error, file=obj)
         print(80*"=", file=obj)
 
+def is_hidden(name):
+    """True for names that start with periods (these are not compared).
+    """
+    return name.startswith('.')
+
+def get_engine():
+    """Returns the CompareEngine (and its DigestCache) used for all folder
+    comparisons, making it the first time it is needed.
+    """
+    global ENGINE
+    if ENGINE is None:
+        cache = DigestCache(os.path.join(os.path.dirname(os.path.abspath(__file__)), DIGEST_CACHE))
+        ENGINE = CompareEngine(READ_WORKERS, READ_WORKERS, cache)
+    return ENGINE
+
+def close_engine():
+    """Stops the comparison threads and saves the digest cache.
+    """
+    global ENGINE
+    if ENGINE is not None:
+        ENGINE.close()
+        ENGINE.cache.close()
+        ENGINE = None
+
 def compare_directories(left, right, write, CHECK_CONTENTS=True):
     """Compares two folders for identical contents.
 
+    File digests are saved in DIGEST_CACHE and rolled up into folder
+    (Merkle) digests, so subfolders that have not changed since they were
+    last checked are skipped without reading their files again. Listings
+    are compared first, so folders with different names or sizes are
+    rejected before any file is read. With CHECK_CONTENTS False, only
+    names, sizes, and times are compared.
+
     written by Phil Wilmarth, OHSU, 2013.
     """
-    for (dirpath, subdirs, files) in os.walk(left):
-        left_path = dirpath
-        right_path = left_path.replace(left, right)
-        dc = filecmp.dircmp(left_path, right_path)
-
-        # trap IOErrors
-        try:
-            # ignore hidden files (start with periods)
-            common_files = no_hidden(dc.common_files)
-            left_only = no_hidden(dc.left_only)
-            right_only = no_hidden(dc.right_only)
-            common_funny = no_hidden(dc.common_funny)
-            diff_files = no_hidden(dc.diff_files)
-            funny_files = no_hidden(dc.funny_files)
-
-            # check common files for identity
-            match, mismatch, errors = [], [], []
-            if CHECK_CONTENTS:
-                (match, mismatch, errors) = filecmp.cmpfiles(left_path, right_path,
-                                                             common_files, shallow=False)
-            # Return Flase if any differences, else True
-            if (left_only or right_only or common_funny or
-                diff_files or funny_files or mismatch or errors):
+    engine = get_engine()
+    try:
+        left_snapshot = TreeSnapshot(left, inodes=CHECK_CONTENTS)
+        right_snapshot = TreeSnapshot(right, inodes=CHECK_CONTENTS)
+        same = set()
+        if CHECK_CONTENTS:
+            left_tree = folder_digests(left_snapshot, cached_digests(left_snapshot, engine.cache), is_hidden)
+            right_tree = folder_digests(right_snapshot, cached_digests(right_snapshot, engine.cache), is_hidden)
+            same = same_folders(left_tree, right_tree)
+
+        # Return False if any differences, else True
+        for (folder, differences, common, changed, error) in diff_snapshots(left_snapshot,
+                                                                            right_snapshot, same):
+            if error:
+                raise error
+            if any(no_hidden(names) for names in differences.values()):
                 return False
-            else:
-                return True
-                    
-        # report IOError or OSError and continue
-        except IOError, e:
-            print_error(write, e, left, right)
-        except OSError, e:
-            print_error(write, e, left, right)
+        for (folder, differences, common, changed, error) in diff_snapshots(left_snapshot,
+                                                                            right_snapshot, same):
+            names = no_hidden(common) if CHECK_CONTENTS else no_hidden(changed)
+            (match, mismatch, errors) = engine.cmpfiles(left_snapshot.path(folder),
+                                                        right_snapshot.path(folder), names)
+            if mismatch or errors:
+                return False
+        return True
 
+    # report IOError or OSError
+    except OSError as e:
+        print_error(write, e, left, right)
         return False
     
 def calc_sha1_hash(file_path):
@@ -105,7 +147,7 @@ def calc_sha1_hash(file_path):
     """
     sha1_hash = hashlib.sha1()
     with open(file_path, 'rb') as file_to_check:
-        for chunk in iter(lambda: file_to_check.read(4096), ''):
+        for chunk in iter(lambda: file_to_check.read(4096), b''):
             sha1_hash.update(chunk)
 
     return sha1_hash.hexdigest()
@@ -159,7 +201,7 @@ def find_duplicates(root, write):
             same = [first]  # list of true duplicates
             diff = []       # list of other non-identical files
             for other in test_list[1:]:     # compare first to the rest
-                if filecmp.cmp(first, other, False):
+                if tiered_cmp(first, other):
                     same.append(other)  # other is a duplicate
                 else:
                     diff.append(other)  # other is different
@@ -281,60 +323,73 @@ def get_volume_free_space(volume):
 
 def copy_project_folder(from_project, to_project, write, success_list, move=False):
     """Copies one project folder contents from "from_project" to "to_project".
-    "from_project" and "to_project" should be full paths. Original and copy
-    are compared for identity and up to 3 retries are attempted. Failure
-    triggers a hard program exit!
+    "from_project" and "to_project" should be full paths ("to_project" can be
+    a list of paths: each file is then read once and written to all of them).
+    Each copied file is checked against the original, and up to 3 retries are
+    attempted for each destination. Failure triggers a hard program exit!
 
     written by Billy Rathje and Phil Wilmarth, OHSU, 2013.
     """
-    # next-to-last safety check - we still have a name conflict to resolve
-    if os.path.exists(to_project):                              
-        if compare_directories(from_project, to_project, write):
+    if isinstance(to_project, str):
+        to_project = [to_project]
+    to_projects = []
+    for to_path in to_project:
+        # next-to-last safety check - we still have a name conflict to resolve
+        if os.path.exists(to_path):
+            if compare_directories(from_project, to_path, write):
+                for obj in write:
+                    print('...WARNING:', os.path.basename(from_project), 'has already been archived.\n', file=obj)
+                if os.path.basename(from_project) not in success_list:
+                    success_list.append(os.path.basename(from_project))
+                continue
+            else:
+                to_path = to_path + '_2'
+
+        # last safety check - make sure new path lengths do not exceed maximum length
+        do_not_copy = check_path_lengths(from_project, to_path, write)
+        if do_not_copy:
             for obj in write:
-                print('...WARNING:', os.path.basename(from_project), 'has already been archived.\n', file=obj)
-            success_list.append(os.path.basename(from_project))
-            return
+                print('...WARNING: %s was NOT copied' % os.path.basename(from_project), file=obj)
+                print('......Some file path names are too long! Manually fix then manually archive.\n', file=obj)
+            reply = raw_input('>>> Continue with moving (y or n)? ')
+            if reply.lower().startswith('n'):
+                sys.exit(0)
         else:
-            to_project = to_project + '_2'
-
-    # last safety check - make sure new path lengths do not exceed maximum length
-    do_not_copy = check_path_lengths(from_project, to_project, write)
-    if do_not_copy:
-        for obj in write:
-            print('...WARNING: %s was NOT copied' % os.path.basename(from_project), file=obj)
-            print('......Some file path names are too long! Manually fix then manually archive.\n', file=obj)
-        reply = raw_input('>>> Continue with moving (y or n)? ')
-        if reply.lower().startswith('n'):
-            sys.exit(0)
+            to_projects.append(to_path)
 
-    # should be safe to try and copy now
-    if not do_not_copy:
-        shutil.copytree(from_project, to_project)
+    # should be safe to try and copy now (source files are read once for all destinations)
+    if to_projects:
+        failed = copy_tree(from_project, to_projects, RETRY)
 
         TRY_COUNT = 3
-        i = 0
-        while (not compare_directories(from_project, to_project, write)) and (i < TRY_COUNT):
-            for obj in write:
-                print('...WARNING: file copy did not occur successfully... retrying...', file=obj)
-                print('......(Try %i of %i )' % (i, TRY_COUNT), file=obj)
-            shutil.rmtree(to_project)
-            time.sleep(5)
-            shutil.copytree(from_project, to_project)
-            i += 1                              
-
-        if i > 2:
-            for obj in write:
-                print('...WARNING: Unable to copy folder ' + from_project, file=obj)
-                print('...Exiting!', file=obj)
-            sys.exit(0)
-        else:
-            if move:
-                shutil.rmtree(from_project)
+        for to_path, failed_files in zip(to_projects, failed):
+            i = 0
+            while failed_files and (i < TRY_COUNT):
                 for obj in write:
-                    print('...%s moved to:\n......%s' % (from_project, to_project), file=obj)
-            else:
+                    print('...WARNING: file copy did not occur successfully... retrying...', file=obj)
+                    print('......%s files did not match in %s' % (len(failed_files), to_path), file=obj)
+                    print('......(Try %i of %i )' % (i, TRY_COUNT), file=obj)
+                shutil.rmtree(to_path)
+                time.sleep(5)
+                failed_files = copy_tree(from_project, [to_path], RETRY)[0]
+                i += 1
+
+            if failed_files:
                 for obj in write:
-                    print('...%s copied to:\n......%s' % (from_project, to_project), file=obj)
+                    print('...WARNING: Unable to copy folder ' + from_project, file=obj)
+                    print('...Exiting!', file=obj)
+                sys.exit(0)
+
+        if move:
+            shutil.rmtree(from_project)
+            for obj in write:
+                for to_path in to_projects:
+                    print('...%s moved to:\n......%s' % (from_project, to_path), file=obj)
+        else:
+            for obj in write:
+                for to_path in to_projects:
+                    print('...%s copied to:\n......%s' % (from_project, to_path), file=obj)
+            if os.path.basename(from_project) not in success_list:
                 success_list.append(os.path.basename(from_project))
 
     return                             
@@ -475,111 +530,135 @@ def create_container_folder(existing_path, write):
 
     return container
                                                               
+def resolve_project_conflict(project, from_here, to_here, write):
+    """Works out where incoming "project" (in "from_here") goes in "to_here".
+    Returns (to_path, container), where "to_path" is None if the project is
+    already there and "container" is the container folder (or None) that
+    should be checked for duplicates after copying.
+
+    written by Phil Wilmarth, OHSU, 2013.
+    """
+    existing_projects = [x for x in os.listdir(to_here) if os.path.isdir(os.path.join(to_here, x))]
+    existing_basenames = [get_basenames(x)[0] for x in existing_projects if len(get_basenames(x)) == 1]
+    # extract project codes from project names (if any)
+    if len(get_basenames(project)) == 1:     # single project code found
+        incoming = get_basenames(project)[0]
+    else:   # non-standard name or meta analysis (multiple projects)
+        incoming = None
+
+    # if no name collision, add project to the archive volume
+    collision = False
+    if incoming in existing_basenames or project in existing_projects:
+        collision = True
+    if not collision:
+        return os.path.join(to_here, project), None
+
+    # name collision so resolve conflict - check if destination is already a container folder
+    incoming_path = os.path.join(from_here, project)
+    existing_path = None
+    # look for existing folder with same name as incoming project
+    match = 0
+    for existing in existing_projects:
+        if project == existing: 
+            existing_path = os.path.join(to_here, existing)
+            print('\nConflict with full name:', existing)
+            match += 1
+    if match > 1:
+        print('WARNING: project matched multiple:', project)
+
+    # next look for basename conflicts
+    if not existing_path:
+        match = 0
+        for existing in existing_projects:
+            if len(get_basenames(existing)) == 1:
+                basename = get_basenames(existing)[0]
+            else: # need to trap when there is not a single basename
+                basename = None
+                print('existing:', existing)
+                print('basenames:', get_basenames(existing))
+            if incoming == basename:
+                existing_path = os.path.join(to_here, existing)
+                print('\nConflict with basename:', existing)
+                match += 1
+        if match > 1:
+            print('WARNING: incoming matched multiple:', incoming)
+            print('DOUBLE WARNING: this case is not being handled!!!')
+            """
+            Need to add some logic here to deal with this case
+            """
+
+    # existing is not a container folder with subprojects
+    if not os.path.exists(os.path.join(existing_path, 'container_folder.txt')):
+
+        # see if incoming is a duplcate of existing
+        if compare_directories(incoming_path, existing_path, write):
+            duplicate = True
+
+        # incoming folder different: create container folder, move into container
+        else:
+            duplicate = False
+            container = create_container_folder(existing_path, write)
+
+    # existing is a container with subprojects
+    else:
+        # get list of subproject folders
+        container = existing_path
+        subproject_list = [x for x in os.listdir(container) if os.path.isdir(os.path.join(container, x))]
+
+        # see if incoming is a duplicate of any existing subprojects
+        duplicate = False
+        for subproject in subproject_list:
+            if compare_directories(incoming_path, os.path.join(container, subproject), write):
+                duplicate = True
+                break
+
+    # do not copy if duplicate, warn user
+    if duplicate:
+        for obj in write:
+            print('...WARNING:', project, 'has already been archived', file=obj)
+        return None, None
+
+    # OK to copy incoming with time stamp to container folder (then check for duplicates)
+    return os.path.join(container, time_stamp_folder(incoming_path)), container
+
 def copy_projects_with_conflict_check(from_here, to_here, write, logfileflag=True):
     """Copies projects from pocket drive to RAID location.
     Makes sure that multiple analyses of same project end up
     as subprojects within the main project folder. Also traps
     the same project trying to replace itself. Uses time stamps
-    to distinguish analyses.
+    to distinguish analyses. "to_here" can be a list of locations
+    (RAID and its backup): conflicts are worked out for each one,
+    then each project is read once and copied to all of them.
     
     written by Phil Wilmarth, OHSU, 2013.
     """
     success_list = []
+    if isinstance(to_here, str):
+        to_here = [to_here]
     
     # get lists of incoming projects and lists of existing projects
     incoming_projects = [x for x in os.listdir(from_here) if os.path.isdir(os.path.join(from_here, x))]
 
     # loop over projects and test for collisions                          
     for project in incoming_projects:
-        existing_projects = [x for x in os.listdir(to_here) if os.path.isdir(os.path.join(to_here, x))]
-        existing_basenames = [get_basenames(x)[0] for x in existing_projects if len(get_basenames(x)) == 1]
-        # extract project codes from project names (if any)
-        if len(get_basenames(project)) == 1:     # single project code found
-            incoming = get_basenames(project)[0]
-        else:   # non-standard name or meta analysis (multiple projects)
-            incoming = None
-
-        # if no name collision, add project to the archive volume
-        collision = False
-        if incoming in existing_basenames or project in existing_projects:
-            collision = True
-        if not collision:            
-            copy_project_folder(os.path.join(from_here, project),
-                                os.path.join(to_here, project), write, success_list)
-            success_list.append(project)
-            
-        # name collision so resolve conflict - check if destination is already a container folder            
-        else:
-            incoming_path = os.path.join(from_here, project)
-            existing_path = None
-            # look for existing folder with same name as incoming project
-            match = 0
-            for existing in existing_projects:
-                if project == existing: 
-                    existing_path = os.path.join(to_here, existing)
-                    print('\nConflict with full name:', existing)
-                    match += 1
-            if match > 1:
-                print('WARNING: project matched multiple:', project)
-                
-            # next look for basename conflicts
-            if not existing_path:
-                match = 0
-                for existing in existing_projects:
-                    if len(get_basenames(existing)) == 1:
-                        basename = get_basenames(existing)[0]
-                    else: # need to trap when there is not a single basename
-                        basename = None
-                        print('existing:', existing)
-                        print('basenames:', get_basenames(existing))
-                    if incoming == basename:
-                        existing_path = os.path.join(to_here, existing)
-                        print('\nConflict with basename:', existing)
-                        match += 1
-                if match > 1:
-                    print('WARNING: incoming matched multiple:', incoming)
-                    print('DOUBLE WARNING: this case is not being handled!!!')
-                    """
-                    Need to add some logic here to deal with this case
-                    """
-
-            # existing is not a container folder with subprojects
-            if not os.path.exists(os.path.join(existing_path, 'container_folder.txt')):
-
-                # see if incoming is a duplcate of existing
-                if compare_directories(incoming_path, existing_path, write):
-                    duplicate = True
-                    
-                # incoming folder different: create container folder, move into container
-                else:
-                    duplicate = False
-                    container = create_container_folder(existing_path, write)
-                    
-            # existing is a container with subprojects
-            else:
-                # get list of subproject folders
-                container = existing_path
-                subproject_list = [x for x in os.listdir(container) if os.path.isdir(os.path.join(container, x))]
-
-                # see if incoming is a duplicate of any existing subprojects
-                duplicate = False
-                for subproject in subproject_list:
-                    if compare_directories(incoming_path, os.path.join(container, subproject), write):
-                        duplicate = True
-                        break
-
-            # do not copy if duplicate, warn user
-            if duplicate:                
-                for obj in write:
-                    print('...WARNING:', project, 'has already been archived', file=obj)
+        to_paths = []
+        containers = []
+        for location in to_here:
+            (to_path, container) = resolve_project_conflict(project, from_here, location, write)
+            if to_path:
+                to_paths.append(to_path)
+            elif project not in success_list:
+                success_list.append(project)    # already archived there
+            if container:
+                containers.append(container)
+
+        # copy to all locations that need it, then check for duplicates
+        if to_paths:
+            copy_project_folder(os.path.join(from_here, project), to_paths, write, success_list)
+            if project not in success_list:
                 success_list.append(project)
-
-            # OK to copy incoming with time stamp to container folder and then check for duplicates                
-            else:
-                new_incoming = time_stamp_folder(incoming_path)
-                copy_project_folder(incoming_path, os.path.join(container, new_incoming),
-                                    write, success_list)
-                find_duplicates(container, write)
+        for container in containers:
+            find_duplicates(container, write)
 
     # update success log file on pocket drive
     if logfileflag:
@@ -727,11 +806,9 @@ def main():
                 for obj in write:
                     print('\nProcessing:', folder, file=obj)
                 
-                # copy to RAID volume
-                copy_projects_with_conflict_check(folder, to_folder, write)        
-
-                # copy to RAID backup also. This makes sure all folder renames and moves stay in sync
-                copy_projects_with_conflict_check(folder, ARCHIVE_BACKUP, write, logfileflag=False)
+                # copy to RAID volume and RAID backup at the same time (each file is read once).
+                # Conflicts are resolved for each volume so all folder renames and moves stay in sync
+                copy_projects_with_conflict_check(folder, [to_folder, ARCHIVE_BACKUP], write)
 
                 # remove successfully achived projects from pocket drive
                 clean_out_previous_projects(folder, folder, write, MODE)                         
@@ -741,6 +818,7 @@ def main():
                 print('Not enough space on destination volume to copy projects. Aborting.', file=obj)
                 print('Pocket drive has %i MB of data, dest. volume has %i MB free.' %
                       (size, get_volume_free_space(to_folder)), file=obj)
+    close_engine()
     try:
         log_obj.close()
     except:
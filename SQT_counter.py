@@ -1,83 +1,353 @@
 #
 # Counts number of scans in SQT files. PW. 06/10/08
 # updated to count unique scan numbers. PW. 06/22/11
+# streaming bytes parser (plain and gzipped SQT files, constant memory)
+# files are counted in parallel worker processes (same output as serial)
+# packed integer scan keys and a charge histogram with any number of charges
+# results are cached so unchanged files are not parsed again
+# census mode counts every project under an analysis folder (no dialog)
 #
 import os, sys
 import gzip
+import zlib
+import hashlib
+import sqlite3
+from concurrent.futures import ProcessPoolExecutor
 import tkinter
 from tkinter import filedialog
 #
-# navigate to folder with SQT files
-#
-root = tkinter.Tk()
-root.withdraw()
-default = os.getcwd()
-default = r'E:\PSR_Core_Analysis'
-root.update()
-sqt_folder_path = filedialog.askdirectory(parent=root, initialdir=default, mustexist=True,
-                                          title='Select a DIR for SQT counting')
-if not sqt_folder_path: sys.exit()
-#
-print(80*'=')
-print(' program "SQT_counter.py", v1.3, written by Phil Wilmarth, OHSU, 2011-2, 2019 ')
-print(80*'=')
-first = os.path.basename(os.path.dirname(sqt_folder_path))
-second = os.path.basename(sqt_folder_path)
-print('..processing:', os.path.join(first, second))
-#
-scans_total = 0
-s_line_total = 0
-z_tot = [0, 0, 0, 0, 0, 0, 0, 0, 0, 0]
-os.chdir(sqt_folder_path)
-L = os.listdir(sqt_folder_path)
-#
-fractions = {}
-for f in [x for x in L if '.sqt' in x]:
-    s_lines = 0
-    scans = {}
-    z = [{}, {}, {}, {}, {}, {}, {}, {}, {}, {}]
-    if '.sqt.gz' in f:
-        f_obj = gzip.open(f, 'rb')
+# SQT files are read in blocks of this size
+BLOCK_SIZE = 4 * 1024 * 1024
+# count files in parallel worker processes (False: one file at a time)
+PARALLEL = True
+# number of worker processes (None: one per CPU)
+WORKERS = None
+# bits used for scan numbers and charge states in the packed scan keys
+SCAN_BITS = 32
+CHARGE_BITS = 8
+# saved per-file counts (kept next to this script; None to turn off)
+CACHE_FILE = 'SQT_counter_cache.db'
+# bytes read from the start and end of a file for its fingerprint
+FINGERPRINT_BYTES = 64 * 1024
+# census mode: walk CENSUS_ROOT (or the folder given on the command line)
+CENSUS = False
+CENSUS_ROOT = r'D:\PSR_Core_Analysis'
+# PAW folders that are counted in census mode
+CENSUS_FOLDERS = ('msn_files', 'filtered_files')
+# census table (tab-delimited) written in the census root folder
+CENSUS_TABLE = 'SQT_census.txt'
+# folder this script is in (before the program changes folders)
+SCRIPT_FOLDER = os.path.dirname(os.path.abspath(__file__))
+#
+def open_sqt(path):
+    # opens plain or gzipped SQT files in binary mode
+    if path.endswith('.gz'):
+        return gzip.open(path, 'rb')
+    else:
+        return open(path, 'rb')
+#
+def s_lines(path):
+    # yields (first scan, last scan, charge) fields (as bytes) for each S line,
+    # reading the file in large blocks so memory use does not grow with file size
+    with open_sqt(path) as f_obj:
+        tail = b''
+        while True:
+            block = f_obj.read(BLOCK_SIZE)
+            if not block:
+                break
+            lines = (tail + block).split(b'\n')
+            tail = lines.pop()  # partial last line
+            for line in lines:
+                if line.startswith(b'S\t'):
+                    yield line.split(b'\t', 4)[1:4]
+        if tail.startswith(b'S\t'):
+            yield tail.split(b'\t', 4)[1:4]
+#
+def ms2_lines(path):
+    # yields (first scan, last scan, charge) fields (as bytes) for each Z line
+    # of an MS2 file (the charge is on the Z lines that follow each S line)
+    scan = None
+    with open_sqt(path) as f_obj:
+        tail = b''
+        while True:
+            block = f_obj.read(BLOCK_SIZE)
+            lines = (tail + block).split(b'\n')
+            tail = lines.pop() if block else b''
+            for line in lines:
+                if line.startswith(b'S\t'):
+                    scan = line.split(b'\t', 3)[1:3]
+                elif line.startswith(b'Z\t') and scan:
+                    yield scan[0], scan[1], line.split(b'\t', 2)[1]
+            if not block:
+                break
+#
+def count_sqt_file(path):
+    # counts S lines (DTAs), unique scans, and unique scans per charge state
+    # in one SQT or MS2 file (runs in the worker processes). Scan ranges are packed
+    # into integers (first scan in the high bits) and the charge goes in the
+    # low bits of a second integer, so there are no per-scan strings or dicts.
+    # Returns (DTAs, scans, {charge: scans})
+    s_line_count = 0
+    scans = set()
+    charge_scans = set()
+    if '.ms2' in os.path.basename(path).lower():
+        spectra = ms2_lines(path)
     else:
-        f_obj = open(f, 'r')
-    for line in f_obj.readlines():
-        temp = line.split('\t')
-        if temp[0] == 'S':
-            s_lines += 1
-            scans[temp[1]+'.'+temp[2]] = True
-            z[int(temp[3])-1][temp[1]+'.'+temp[2]] = True
-    print('....file:',f, 'had %s DTAs and %s scans' % (s_lines, len(scans)))
+        spectra = s_lines(path)
+    for (first_scan, last_scan, charge) in spectra:
+        s_line_count += 1
+        scan = (int(first_scan) << SCAN_BITS) | int(last_scan)
+        scans.add(scan)
+        charge_scans.add((scan << CHARGE_BITS) | int(charge))
     #
-    # keep track of total scans and DTAs per fraction
+    # charge histogram only has the charges that were seen
     #
+    z_counts = {}
+    mask = (1 << CHARGE_BITS) - 1
+    for key in charge_scans:
+        z_counts[key & mask] = z_counts.get(key & mask, 0) + 1
+    return s_line_count, len(scans), z_counts
+#
+def try_count_sqt_file(path):
+    # counts one file (in the worker processes) without stopping the batch if
+    # it is unreadable, truncated or garbled. Returns (result, error message),
+    # where result is None if the file could not be counted.
+    try:
+        return count_sqt_file(path), None
+    except (OSError, EOFError, ValueError, zlib.error) as error:
+        return None, '%s: %s' % (type(error).__name__, error)
+#
+def file_key(path):
+    # (size, mtime, fingerprint) identifying the contents of a file; the
+    # fingerprint is a hash of the first and last few KB
+    stat_info = os.stat(path)
+    fingerprint = hashlib.sha256()
+    with open(path, 'rb') as f_obj:
+        fingerprint.update(f_obj.read(FINGERPRINT_BYTES))
+        if stat_info.st_size > 2 * FINGERPRINT_BYTES:
+            f_obj.seek(-FINGERPRINT_BYTES, 2)
+            fingerprint.update(f_obj.read(FINGERPRINT_BYTES))
+    return stat_info.st_size, stat_info.st_mtime_ns, fingerprint.hexdigest()[:32]
+#
+def open_cache(db_path):
+    # opens (creates) the per-file results cache
+    db = sqlite3.connect(db_path)
+    db.execute('CREATE TABLE IF NOT EXISTS counts (path TEXT PRIMARY KEY, size INTEGER, '
+               'mtime INTEGER, fingerprint TEXT, dtas INTEGER, scans INTEGER, charges TEXT)')
+    return db
+#
+def cache_lookup(db, path, key):
+    # returns saved (DTAs, scans, {charge: scans}) for the file or None if unknown or changed
+    row = db.execute('SELECT size, mtime, fingerprint, dtas, scans, charges FROM counts '
+                     'WHERE path=?', (path,)).fetchone()
+    if not row or tuple(row[:3]) != key:
+        return None
+    z_counts = {}
+    for item in row[5].split():
+        (charge, count) = item.split(':')
+        z_counts[int(charge)] = int(count)
+    return row[3], row[4], z_counts
+#
+def cache_store(db, path, key, result):
+    # saves (or replaces) the counts for a file
+    (s_line_count, scan_count, z_counts) = result
+    charges = ' '.join(['%s:%s' % item for item in sorted(z_counts.items())])
+    db.execute('INSERT OR REPLACE INTO counts VALUES (?, ?, ?, ?, ?, ?, ?)',
+               (path, key[0], key[1], key[2], s_line_count, scan_count, charges))
+#
+def fraction_key(f):
+    # fraction name for an SQT file name
     if 'filtered' in f:
         temp = f.split('_')
-        key = '_'.join(temp[:-2])
+        return '_'.join(temp[:-2])
+    else:
+        return f
+#
+def census_fraction(f):
+    # fraction name for the census table: the file name without its SQT or
+    # MS2 extension (gzipped or not), then as in fraction_key
+    name = f[:-3] if f.lower().endswith('.gz') else f
+    for extension in ('.sqt', '.ms2'):
+        if name.lower().endswith(extension):
+            name = name[:-len(extension)]
+    return fraction_key(name)
+#
+def count_files(paths):
+    # counts the files (absolute paths) in worker processes, using saved
+    # results for unchanged files. Files that cannot be read are skipped with
+    # a warning. Returns a list of (DTAs, scans, {charge: scans}) in file
+    # order (None for skipped files) and the number of files from the cache.
+    cached = {}
+    keys = {}
+    if CACHE_FILE:
+        db = open_cache(os.path.join(SCRIPT_FOLDER, CACHE_FILE))
+        for path in paths:
+            try:
+                keys[path] = file_key(path)
+            except OSError:
+                continue    # not cached; counting it will report the problem
+            result = cache_lookup(db, path, keys[path])
+            if result:
+                cached[path] = result
+    to_count = [path for path in paths if path not in cached]
+    #
+    # results come back in file order
+    #
+    if PARALLEL and len(to_count) > 1:
+        with ProcessPoolExecutor(WORKERS) as executor:
+            counted = list(executor.map(try_count_sqt_file, to_count))
     else:
-        key = f
-    if fractions.get(key, False):
-        (frac_dta, frac_scan) = fractions[key]
-        frac_dta += s_lines
-        frac_scan += len(scans)
-        fractions[key] = (frac_dta, frac_scan)
+        counted = [try_count_sqt_file(path) for path in to_count]
+    counted = dict(zip(to_count, counted))
+    #
+    results = []
+    for path in paths:
+        if path in cached:
+            results.append(cached[path])
+            continue
+        (result, error) = counted[path]
+        if error:
+            print('....WARNING: could not count %s (%s)' % (path, error))
+        elif CACHE_FILE and path in keys:
+            cache_store(db, path, keys[path], result)
+        results.append(result)
+    if CACHE_FILE:
+        db.commit()
+        db.close()
+    return results, len(cached)
+#
+def census_files(census_root):
+    # finds the PAW msn_files and filtered_files folders under census_root;
+    # returns a list of (project, folder, file name, path) for SQT and MS2 files
+    found = []
+    for (dirpath, dirnames, filenames) in os.walk(census_root):
+        dirnames.sort()
+        if os.path.basename(dirpath) not in CENSUS_FOLDERS:
+            continue
+        dirnames[:] = []    # PAW does not nest these folders
+        project = os.path.relpath(os.path.dirname(dirpath), census_root)
+        for f in sorted(filenames):
+            name = f.lower()
+            if name.endswith(('.sqt', '.sqt.gz', '.ms2', '.ms2.gz')):
+                found.append((project, os.path.basename(dirpath), f,
+                              os.path.abspath(os.path.join(dirpath, f))))
+    return found
+#
+def census(census_root):
+    # counts every SQT and MS2 file in the projects under census_root and
+    # writes one table row per project, folder, fraction and file
+    print(80*'=')
+    print(' program "SQT_counter.py", v1.3, written by Phil Wilmarth, OHSU, 2011-2, 2019 ')
+    print(80*'=')
+    print('..census of:', census_root)
+    found = census_files(census_root)
+    projects = set([(project, folder) for (project, folder, f, path) in found])
+    print('....%s files in %s folders' % (len(found), len(projects)))
+    #
+    (results, cached) = count_files([path for (project, folder, f, path) in found])
+    #
+    # one column per charge state seen anywhere
+    #
+    charges = set()
+    for result in results:
+        if result:
+            charges.update(result[2])
+    charges = sorted(charges)
+    #
+    table_path = os.path.join(census_root, CENSUS_TABLE)
+    with open(table_path, 'w') as table:
+        header = ['Project', 'Folder', 'Fraction', 'File', 'DTAs', 'Scans']
+        header += ['%s+ scans' % charge for charge in charges]
+        print('\t'.join(header), file=table)
+        for (project, folder, f, path), result in zip(found, results):
+            if not result:
+                continue    # could not be counted (warning printed above)
+            (s_line_count, scan_count, z_counts) = result
+            row = [project, folder, census_fraction(f), f, s_line_count, scan_count]
+            row += [z_counts.get(charge, 0) for charge in charges]
+            print('\t'.join([str(x) for x in row]), file=table)
+    if cached:
+        print('....(%s of %s files were counted in an earlier run)' % (cached, len(found)))
+    skipped = results.count(None)
+    if skipped:
+        print('....%s files could not be counted and are not in the table' % skipped)
+    print('..census table written to:', table_path)
+#
+def main():
+    #
+    # navigate to folder with SQT files
+    #
+    root = tkinter.Tk()
+    root.withdraw()
+    default = os.getcwd()
+    default = r'E:\PSR_Core_Analysis'
+    root.update()
+    sqt_folder_path = filedialog.askdirectory(parent=root, initialdir=default, mustexist=True,
+                                              title='Select a DIR for SQT counting')
+    if not sqt_folder_path: sys.exit()
+    #
+    print(80*'=')
+    print(' program "SQT_counter.py", v1.3, written by Phil Wilmarth, OHSU, 2011-2, 2019 ')
+    print(80*'=')
+    first = os.path.basename(os.path.dirname(sqt_folder_path))
+    second = os.path.basename(sqt_folder_path)
+    print('..processing:', os.path.join(first, second))
+    #
+    scans_total = 0
+    s_line_total = 0
+    z_tot = {}
+    os.chdir(sqt_folder_path)
+    L = os.listdir(sqt_folder_path)
+    sqt_files = [x for x in L if '.sqt' in x]
+    paths = [os.path.abspath(os.path.join(sqt_folder_path, f)) for f in sqt_files]
+    #
+    # only new or changed files need to be parsed
+    #
+    (results, cached) = count_files(paths)
+    fractions = {}
+    for f, result in zip(sqt_files, results):
+        if not result:
+            continue    # could not be counted (warning printed above)
+        (s_line_count, scan_count, z_counts) = result
+        print('....file:',f, 'had %s DTAs and %s scans' % (s_line_count, scan_count))
+        #
+        # keep track of total scans and DTAs per fraction
+        #
+        key = fraction_key(f)
+        if fractions.get(key, False):
+            (frac_dta, frac_scan) = fractions[key]
+            frac_dta += s_line_count
+            frac_scan += scan_count
+            fractions[key] = (frac_dta, frac_scan)
+        else:
+            fractions[key] = (s_line_count, scan_count)
+        #
+        scans_total += scan_count
+        s_line_total += s_line_count
+        for charge, count in z_counts.items():
+            z_tot[charge] = z_tot.get(charge, 0) + count
+    if cached:
+        print('....(%s of %s files were counted in an earlier run)' % (cached, len(paths)))
+    #
+    print('\n..total number of s_lines: %s and scans: %s' % (s_line_total, scans_total))
+    for charge, tot in sorted(z_tot.items()):
+        if tot > 0:
+            print('....total number of %s+ scans was %s' % (str(charge), str(tot)))
+    print()
+    items = list(fractions.items())
+    items.sort()
+    for key, value in items:
+        print('..frac: %s had %s DTAs and %s MS2 scans' % (key, value[0], value[1]))
+#
+# worker processes import this file, so only the main process runs the program
+#
+if __name__ == '__main__':
+    if len(sys.argv) > 1:
+        census(sys.argv[1])
+    elif CENSUS:
+        census(CENSUS_ROOT)
     else:
-        fractions[key] = (s_lines, len(scans))
-    #
-    scans_total += len(scans)
-    s_line_total += s_lines
-    for i, d in enumerate(z):
-        z_tot[i] += len(d)
-#
-print('\n..total number of s_lines: %s and scans: %s' % (s_line_total, scans_total))
-for i, tot in enumerate(z_tot):
-    if tot > 0:
-        print('....total number of %s+ scans was %s' % (str(i+1), str(tot)))
-print()
-items = list(fractions.items())
-items.sort()
-for key, value in items:
-    print('..frac: %s had %s DTAs and %s MS2 scans' % (key, value[0], value[1]))
+        main()
 #
 # end
 #
-                
@@ -4,17 +4,49 @@ written by Phil Wilmarth, OHSU, 2012
 updated for Python 3, Feb. 2018
 
 added filtering of non-ASCII characters - 2/18/2017 -PW
+file contents are compared on a thread pool (see compare_tools.py)
+file digests are saved so unchanged files are not read again
+each tree is listed once with os.scandir instead of os.walk + filecmp.dircmp
+added manifest export and verification modes (see MODE flag)
+identical subtrees are skipped using folder (Merkle) digests
+added gzip-transparent comparisons of archived (.gz) and working copies
+files are compared in tiers (size, sampled blocks, whole file; see QUICK_CHECK)
+differences can also be streamed to a JSONL or CSV file (see REPORT_FILE)
+moved or renamed files can be found by size and contents (see FIND_MOVES)
+added progress/ETA lines, throughput numbers, and a run record (see RUN_RECORD)
 """
 import os
 import sys
+import json
 import time
-import filecmp
+import collections
 import tkinter
 from tkinter import filedialog
 
+from compare_tools import CompareEngine, DigestCache, TreeSnapshot, diff_snapshots
+from compare_tools import ManifestSnapshot, write_manifest, folder_digests, cached_digests, same_folders
+from compare_tools import pair_gzip, DiffReporter, find_moves, RunStats, compared_bytes
+from compare_tools import format_bytes, format_seconds
+
+# 'compare' two directories, 'export' a manifest file of one directory,
+# or 'verify' a directory against a manifest (the other drive need not be mounted)
+MODE = 'compare'
 LEVELS = 3              # how many subfolder levels for printing
 CHECK_CONTENTS = True   # checks actual contents of files
+QUICK_CHECK = False     # only checks sizes and sampled blocks of contents (for triage runs)
 VERBOSE = False         # if True, prints "no difference" folders
+LEFT_WORKERS = 4        # concurrent content reads on the first directory
+RIGHT_WORKERS = 4       # concurrent content reads on the second directory
+PENDING_FOLDERS = 64    # folders queued for comparison before printing starts
+CACHE_FILE = 'compare_dir_cache.db'  # saved file digests (None to always read files)
+SKIP_SAME_FOLDERS = True  # skip identical subtrees (folder digests; needs CACHE_FILE)
+GZIP_PAIRS = False      # compare "foo.sqt" to "foo.sqt.gz" (after Project_archiver.py)
+REPORT_FILE = None      # e.g. 'compare_dir_diffs.jsonl' or '.csv' (one record per difference)
+REPORT_SUMMARY = True   # add a summary record with counts and bytes compared
+FIND_MOVES = False      # pair left_only and right_only files with the same contents
+PROGRESS_SECONDS = 10   # seconds between progress lines on the console (None for no lines)
+SLOWEST = 10            # how many of the slowest folders and files to list
+RUN_RECORD = 'compare_dir_runs.jsonl'  # timing record appended for each run (None to skip)
 
 def strip(s):
     """Strips non-Ascii characters from strings."""
@@ -50,11 +82,32 @@ def get_folder(default_location, title_string=None):
     # return full folder name
     return full_folder_name
 
+def get_manifest(default_location, save=False):
+    """Dialog box to browse to a manifest file.  Returns file path.
+    If "save" is True, a new file name can be given for an export.
+    """
+    # set up GUI elements
+    root = tkinter.Tk()
+    root.withdraw()
+    root.update()
+    file_types = [('Manifest files', '*.manifest *.manifest.gz'), ('All files', '*.*')]
+    if save:
+        return filedialog.asksaveasfilename(parent=root, initialdir=default_location,
+                                            filetypes=file_types, defaultextension='.manifest',
+                                            title='Save manifest file as')
+    return filedialog.askopenfilename(parent=root, initialdir=default_location,
+                                      filetypes=file_types, title='Select a manifest file')
+
 def no_hidden(files):
     """Removes files that start with periods.
     """
     return([x for x in files if not x.startswith('.')])
 
+def is_hidden(name):
+    """True for names that start with periods.
+    """
+    return name.startswith('.')
+
 def print_files(log_file_list, prefix, title, file_list):
     """Prints list of file with leading title.
     """
@@ -68,9 +121,12 @@ def print_files(log_file_list, prefix, title, file_list):
                 print('%s%s%s' % (prefix, prefix, strip(f)), file=obj)
     return
 
-def print_error(log_file_list, error):
+def print_error(log_file_list, error, left_path, right_path):
     """Prints any errors being trapped.
     """
+    counts['error'] += 1
+    if reporter:
+        reporter.record('error', left_path, right_path, '', error)
     for obj in log_file_list:
         print(80*"=", file=obj)
         print('WARNING:', strip(left_path), file=obj)
@@ -78,22 +134,90 @@ def print_error(log_file_list, error):
         print(error, file=obj)
         print(80*"=", file=obj)
 
+def report_folder(log_file_list, top, left_path, right_path, differences, jobs, folder_bytes):
+    """Waits for the content checks of one folder and prints what was different.
+    "differences" is a dictionary of name lists from the folder listing,
+    "jobs" are the queued content comparisons of the common files, and
+    "folder_bytes" is the size of the left folder's files (for progress).
+    """
+    (match, mismatch, errors) = engine.collect(jobs)
+    for title in differences:
+        counts[title] += len(differences[title])
+    counts['mismatch'] += len(mismatch)
+    counts['error'] += len(errors)
+    stats.folder_done(left_path, folder_bytes)
+    stats.show_progress(engine)
+
+    # report records follow the scan order, like the printed lines
+    if reporter:
+        for title in ['left_only', 'right_only', 'common_funny', 'diff_files', 'funny_files']:
+            for name in differences[title]:
+                reporter.record(title, left_path, right_path, name)
+        for name in mismatch:
+            reporter.record('mismatch', left_path, right_path, name)
+        for name in errors:
+            reporter.record('error', left_path, right_path, name, 'file could not be read')
+
+    # only print if there was a difference
+    if any(differences.values()) or mismatch or errors:
+        prefix = '   '
+        for obj in log_file_list:
+            print('\n-->', strip(left_path), strip(right_path), file=obj)
+        for title in ['left_only', 'right_only', 'common_funny', 'diff_files', 'funny_files']:
+            if differences[title]:
+                print_files(log_file_list, prefix, title + ':', differences[title])
+        if mismatch:
+            print_files(log_file_list, prefix, '\nmismatches:', mismatch)
+        if errors:
+            print_files(log_file_list, prefix, 'file errors:', errors)
+        for obj in log_file_list:
+            print(file=obj)
+
+    else:
+        depth = os.path.normpath(left_path).count(sep) - top
+        if depth <= LEVELS and VERBOSE:
+            prefix = '...' * depth
+            for obj in log_file_list:
+                print('%s%s: %s' % (prefix, os.path.basename(strip(left_path)),
+                                           '-OK-'), file=obj)
+
+def report_pending(log_file_list, top, pending, keep=0):
+    """Prints queued folders (oldest first) until only "keep" are left waiting.
+    """
+    while len(pending) > keep:
+        report_folder(log_file_list, top, *pending.popleft())
+
 
 default = os.getcwd()
 default = 'C:\\'
-left = get_folder(default, 'Select first directory')
+if MODE == 'compare':
+    left = get_folder(default, 'Select first directory')
+else:
+    left = get_folder(default, 'Select directory')
 if not left: sys.exit()
-right = get_folder(default, 'Select second directory')
+if MODE == 'compare':
+    right = get_folder(default, 'Select second directory')
+else:
+    right = get_manifest(default, save=(MODE == 'export'))
 if not right: sys.exit()
 log_file = open('compare_dir_log.txt', 'a')
 write = [None, log_file]
+reporter = None
+if REPORT_FILE and MODE != 'export':
+    reporter = DiffReporter(REPORT_FILE)
 
 for obj in write:
     print('\n\n=================================================================', file=obj)
     print('  compare_directories.py, v1.4, Phil Wilmarth, OHSU, 2012, 2017  ', file=obj)
     print('=================================================================', file=obj)
     print('   Ran on: %s\n' % (time.ctime(),), file=obj)
-    if CHECK_CONTENTS:
+    if MODE == 'export':
+        print('Writing manifest of:', strip(left), file=obj)
+        print('                 To:', strip(right), '\n', file=obj)
+        continue
+    if CHECK_CONTENTS and QUICK_CHECK:
+        print('File sizes and sampled blocks of contents will be checked.', file=obj)
+    elif CHECK_CONTENTS:
         print('File contents and attributes will be verified.', file=obj)
     else:
         print('File attributes only will be checked.', file=obj)
@@ -103,69 +227,155 @@ for obj in write:
 sep = os.path.sep
 top = os.path.normpath(left).count(sep)
 
-for (dirpath, subdirs, files) in os.walk(left):
-    left_path = dirpath
-    right_path = left_path.replace(left, right)
-    dc = filecmp.dircmp(left_path, right_path)
+# content comparisons run on a thread pool; folders are reported in walk order
+# unchanged files are compared using digests saved by earlier runs
+cache = None
+if (CHECK_CONTENTS or MODE == 'export') and CACHE_FILE:
+    cache = DigestCache(CACHE_FILE)
+engine = CompareEngine(LEFT_WORKERS, RIGHT_WORKERS, cache, QUICK_CHECK)
+pending = collections.deque()
 
-    # trap IOErrors
-    try:
-        # ignore hidden files (start with periods)
-        common_files = no_hidden(dc.common_files)
-        left_only = no_hidden(dc.left_only)
-        right_only = no_hidden(dc.right_only)
-        common_funny = no_hidden(dc.common_funny)
-        diff_files = no_hidden(dc.diff_files)
-        #######################################
-        diff_files = [x for x in diff_files if x != "gzipped_files.log"]
-        ########################################        
-        funny_files = no_hidden(dc.funny_files)
-
-        # check common files for identity
-        match, mismatch, errors = [], [], []
-        if CHECK_CONTENTS:
-            (match, mismatch, errors) = filecmp.cmpfiles(left_path, right_path,
-                                                         common_files, shallow=False)
-        # only print if there was a difference
-        pflag = False
-        if (left_only or right_only or common_funny or diff_files or funny_files
-            or mismatch or errors):
-            pflag = True
-
-        # print what was different
-        if pflag:
-            prefix = '   '
-            for obj in write:
-                print('\n-->', strip(left_path), strip(right_path), file=obj)
-            if left_only:
-                print_files(write, prefix, 'left_only:', left_only)
-            if right_only:
-                print_files(write, prefix, 'right_only:', right_only)
-            if common_funny:
-                print_files(write, prefix, 'common_funny:', common_funny)
-            if diff_files:
-                print_files(write, prefix, 'diff_files:', diff_files)
-            if funny_files:
-                print_files(write, prefix, 'funny_files:', funny_files)
-            if mismatch:
-                print_files(write, prefix, '\nmismatches:', mismatch)
-            if errors:
-                print_files(write, prefix, 'file errors:', errors)
-            print(file=obj)
+# list each tree once (or read the manifest), then compare the listings folder by folder
+# (inodes are kept so saved digests can be checked without stat calls)
+left_snapshot = TreeSnapshot(left, inodes=cache is not None)
+stats = RunStats(0, SLOWEST, PROGRESS_SECONDS or 0, print if PROGRESS_SECONDS else None)
+engine.stats = stats
+counts = collections.Counter()
+if MODE == 'export':
+    stats.add_work(compared_bytes(left_snapshot))
+    (file_count, byte_count, errors) = write_manifest(left_snapshot, right, engine)
+    for (relative, error) in errors:
+        print_error(write, error, os.path.join(left, relative), right)
+    for obj in write:
+        print('%s files (%0.1f MB) written to manifest' % (file_count, byte_count/1024.0/1024.0), file=obj)
+elif MODE == 'verify':
+    right_snapshot = ManifestSnapshot(right)
+else:
+    right_snapshot = TreeSnapshot(right, inodes=cache is not None)
+if MODE != 'export':
+    # progress only counts folders on both sides (left_only subtrees are not read)
+    stats.add_work(compared_bytes(left_snapshot, right_snapshot))
+
+# find identical subtrees from folder digests built from saved file digests only
+# (nothing is read here; the checks below save digests for the next run)
+same = set()
+if MODE != 'export' and CHECK_CONTENTS and cache and SKIP_SAME_FOLDERS and not QUICK_CHECK:
+    left_tree = folder_digests(left_snapshot, cached_digests(left_snapshot, cache), is_hidden)
+    if MODE == 'verify':
+        right_tree = folder_digests(right_snapshot, right_snapshot.digests, is_hidden)
+    else:
+        right_tree = folder_digests(right_snapshot, cached_digests(right_snapshot, cache), is_hidden)
+    same = same_folders(left_tree, right_tree)
+
+# files that only moved (or were renamed) are reported as pairs instead of left_only/right_only
+# (the folder differences are then listed once and used for both passes)
+moves, left_moved, right_moved = [], set(), set()
+if MODE == 'export':
+    folder_differences = []
+elif FIND_MOVES:
+    folder_differences = list(diff_snapshots(left_snapshot, right_snapshot, same))
+    (moves, left_moved, right_moved) = find_moves(left_snapshot, right_snapshot, engine,
+                                                  folder_differences, is_hidden)
+else:
+    folder_differences = diff_snapshots(left_snapshot, right_snapshot, same)
+for (folder, differences, common, changed, error) in folder_differences:
+    left_path = left_snapshot.path(folder)
+    right_path = right_snapshot.path(folder)
+
+    # report IOError or OSError (after any earlier folders) and continue
+    if error:
+        report_pending(write, top, pending)
+        print_error(write, error, left_path, right_path)
+        continue
+
+    # ignore hidden files (start with periods)
+    for title in differences:
+        differences[title] = no_hidden(differences[title])
+    #######################################
+    differences['diff_files'] = [x for x in differences['diff_files'] if x != "gzipped_files.log"]
+    ########################################
+    if moves:
+        differences['left_only'] = [x for x in differences['left_only']
+                                    if os.path.join(folder, x) not in left_moved]
+        differences['right_only'] = [x for x in differences['right_only']
+                                     if os.path.join(folder, x) not in right_moved]
+    pairs = []
+    if GZIP_PAIRS:
+        for title in ['left_only', 'right_only']:
+            differences[title] = [x for x in differences[title] if x != "gzipped_files.log"]
+        pairs = pair_gzip(differences, MODE == 'verify')
+        if not CHECK_CONTENTS:
+            pairs = []  # names match; contents not checked
 
-        else:
-            depth = os.path.normpath(left_path).count(sep) - top
-            if depth <= LEVELS and VERBOSE:
-                prefix = '...' * depth
-                for obj in write:
-                    print('%s%s: %s' % (prefix, os.path.basename(strip(left_path)),
-                                               '-OK-'), file=obj)
-                
-    # report IOError or OSError and continue
-    except IOError as e:
-        print_error(write, e)
-    except OSError as e:
-        print_error(write, e)
+    # queue common files for identity checks (or just the ones with new times)
+    if CHECK_CONTENTS:
+        names = no_hidden(common)
+    else:
+        names = no_hidden(changed)
+    if MODE == 'verify':
+        expected = right_snapshot.digests.get(folder, {})
+        jobs = engine.submit_expected(left_path, names, expected)
+        jobs += engine.submit_gzip(left_path, right_path, pairs, expected)
+    else:
+        jobs = engine.submit(left_path, right_path, names)
+        jobs += engine.submit_gzip(left_path, right_path, pairs)
+    pending.append((left_path, right_path, differences, jobs, sum(left_snapshot.folders[folder][2])))
+
+    # print the oldest folders once enough are queued
+    report_pending(write, top, pending, PENDING_FOLDERS)
+
+# print the folders still waiting
+report_pending(write, top, pending)
+
+# print the moved files
+counts['moved'] = len(moves)
+if moves:
+    for obj in write:
+        print('\n-->', strip(left), strip(right), file=obj)
+    print_files(write, '   ', 'moved or renamed files (same contents):',
+                ['%s -> %s' % (left_file, right_file) for (left_file, right_file) in moves])
+    for obj in write:
+        print(file=obj)
+    if reporter:
+        for (left_file, right_file) in moves:
+            reporter.record('moved', left_snapshot.path(os.path.dirname(left_file)),
+                            right_snapshot.path(os.path.dirname(right_file)),
+                            os.path.basename(left_file), os.path.basename(right_file))
+engine.close()
+if cache:
+    cache.close()
+
+# print timing and throughput, and save the run record
+summary = stats.summary(engine)
+for obj in write:
+    if MODE == 'export':
+        print('\nFinished in %s' % format_seconds(summary['seconds']), file=obj)
+    else:
+        print('\nFinished in %s: %s files (%s) compared, %0.1f files/s' %
+              (format_seconds(summary['seconds']), summary['files_compared'],
+               format_bytes(summary['bytes_compared']), summary['files_per_second']), file=obj)
+    print('Read %s from first (%0.1f MB/s) and %s from second (%0.1f MB/s)' %
+          (format_bytes(summary['left_bytes_read']), summary['left_mb_per_second'],
+           format_bytes(summary['right_bytes_read']), summary['right_mb_per_second']), file=obj)
+    if MODE != 'export' and summary['slowest_folders']:
+        print('Slowest folders (seconds):', file=obj)
+        for (seconds, path) in summary['slowest_folders']:
+            print('   %8.2f  %s' % (seconds, strip(path)), file=obj)
+    if summary['slowest_files']:
+        print('Slowest files (seconds):', file=obj)
+        for (seconds, path) in summary['slowest_files']:
+            print('   %8.2f  %s' % (seconds, strip(path)), file=obj)
+if RUN_RECORD:
+    summary.update({'ran_on': time.ctime(stats.start), 'mode': MODE, 'left': left, 'right': right,
+                    'check_contents': CHECK_CONTENTS, 'quick_check': QUICK_CHECK,
+                    'differences': {title: n for (title, n) in counts.items() if n}})
+    with open(RUN_RECORD, 'a') as run_obj:
+        print(json.dumps(summary), file=run_obj)
+if reporter:
+    reporter.close({'files_compared': engine.files_compared,
+                    'bytes_compared': engine.bytes_compared} if REPORT_SUMMARY else None)
+    for obj in write:
+        print('Differences written to:', REPORT_FILE, file=obj)
 #
 try:    # wait for user to end program if not running from IDLE
     # what __file__ is under XP IDLE: 'C:\\Python26\\Lib\\idlelib\\idle.pyw'
@@ -0,0 +1,1169 @@
+"""compare_tools.py
+Shared file and folder comparison helpers for the scripts in this folder.
+There is no GUI code in here so the functions can also be used by scripts
+that run without a person at the keyboard. Keep this file in the same
+folder as the scripts that import it.
+"""
+import os
+import csv
+import json
+import stat
+import gzip
+import time
+import heapq
+import zlib
+import struct
+import hashlib
+import contextlib
+import collections
+import sqlite3
+import threading
+from array import array
+from concurrent.futures import ThreadPoolExecutor
+
+# read size for content comparisons
+BUFSIZE = 1024 * 1024
+# size of the head, middle, and tail blocks checked before reading whole files
+SAMPLE_SIZE = 1024 * 1024
+# files smaller than this are read in full without checking samples first
+SAMPLE_MIN = 8 * SAMPLE_SIZE
+# hash function used for content digests
+HASH_NAME = 'sha256'
+# how many new cache entries to collect before writing them to disk
+CACHE_COMMIT = 1000
+# how many paths to look up in the cache with one query
+CACHE_BATCH = 500
+# block size for the chunk digests in manifest files
+MANIFEST_CHUNK = 64 * 1024 * 1024
+# added to a .gz file path to save the digest of its decompressed contents
+GUNZIP_KEY = '#gunzip'
+
+class ReadGate:
+    """Limits the number of concurrent reads on one device (one side of a
+    comparison) and counts the bytes read through it. A limit of None
+    means reads are not limited.
+
+    Usage: gate = ReadGate(4)
+           block = gate.read(file_obj, size)
+           with gate: ...   # other work that should count against the limit
+    """
+    def __init__(self, limit=None):
+        self.semaphore = threading.BoundedSemaphore(max(1, limit)) if limit else contextlib.nullcontext()
+        self.lock = threading.Lock()
+        self.bytes_read = 0
+
+    def __enter__(self):
+        self.semaphore.__enter__()
+        return self
+
+    def __exit__(self, *exc_info):
+        return self.semaphore.__exit__(*exc_info)
+
+    def read(self, file_obj, size):
+        """Reads up to "size" bytes from "file_obj" while holding the gate.
+        """
+        with self.semaphore:
+            block = file_obj.read(size)
+        with self.lock:
+            self.bytes_read += len(block)
+        return block
+
+# used when reads are not limited
+NO_GATE = ReadGate()
+
+def new_hash():
+    """Returns a new hash object for content digests.
+    """
+    return hashlib.new(HASH_NAME)
+
+def sample_offsets(size):
+    """Returns the offsets of the head, middle, and tail sample blocks.
+    """
+    return sorted({0, max(0, size//2 - SAMPLE_SIZE//2), max(0, size - SAMPLE_SIZE)})
+
+def samples_match(left_file, right_file, size, left_gate=NO_GATE, right_gate=NO_GATE):
+    """Compares the head, middle, and tail blocks of two files of length "size".
+    Returns False as soon as a block differs.
+    """
+    with open(left_file, 'rb') as left_obj, open(right_file, 'rb') as right_obj:
+        for offset in sample_offsets(size):
+            left_obj.seek(offset)
+            left_block = left_gate.read(left_obj, SAMPLE_SIZE)
+            right_obj.seek(offset)
+            right_block = right_gate.read(right_obj, SAMPLE_SIZE)
+            if left_block != right_block:
+                return False
+    return True
+
+def contents_match(left_file, right_file, left_gate=NO_GATE, right_gate=NO_GATE,
+                   bufsize=BUFSIZE, left_hash=None, right_hash=None):
+    """Reads two files block by block and returns True if they are identical.
+    If hash objects are passed, they are updated with the data as it is read
+    (they are only complete if True is returned).
+    """
+    with open(left_file, 'rb') as left_obj, open(right_file, 'rb') as right_obj:
+        while True:
+            left_block = left_gate.read(left_obj, bufsize)
+            right_block = right_gate.read(right_obj, bufsize)
+            if left_block != right_block:
+                return False
+            if not left_block:
+                return True
+            if left_hash is not None:
+                left_hash.update(left_block)
+                right_hash.update(right_block)
+
+def tiered_cmp(left_file, right_file, quick=False):
+    """Drop-in replacement for filecmp.cmp(left_file, right_file, shallow=False).
+
+    Differences are looked for in tiers so most mismatches are found
+    quickly: file sizes first, then sampled head, middle, and tail blocks,
+    then the whole files. With "quick" True, files that pass the sample
+    tier are called identical without being read in full (for triage runs).
+    """
+    left_stat = os.stat(left_file)
+    right_stat = os.stat(right_file)
+    if not (stat.S_ISREG(left_stat.st_mode) and stat.S_ISREG(right_stat.st_mode)):
+        return False
+    if left_stat.st_size != right_stat.st_size:
+        return False
+    if left_stat.st_size >= SAMPLE_MIN or quick:
+        if not samples_match(left_file, right_file, left_stat.st_size):
+            return False
+        if quick:
+            return True
+    return contents_match(left_file, right_file)
+
+class DigestCache:
+    """Persistent table of file content digests.
+
+    Entries are keyed on the full file path and are only used if the
+    file size, modification time and inode (file index on Windows) are
+    unchanged since the digest was computed. Any change in the stat data
+    means the file gets read again and the entry is replaced. The table
+    is a small SQLite database so it can hold millions of files.
+
+    Usage: cache = DigestCache(db_path)
+           digest = cache.lookup(path, os.stat(path))   # None if unknown or stale
+           digests = cache.lookup_many({path: (size, mtime_ns, inode)})
+           cache.store(path, os.stat(path), digest)
+           cache.close()
+    """
+    def __init__(self, db_path):
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(db_path, check_same_thread=False)
+        self.db.execute('CREATE TABLE IF NOT EXISTS digests (path TEXT PRIMARY KEY, '
+                        'size INTEGER, mtime INTEGER, inode INTEGER, digest TEXT)')
+        self.db.commit()
+        self.uncommitted = 0
+
+    def lookup(self, path, stat_info):
+        """Returns the saved digest of "path" or None if missing or out of date.
+        """
+        with self.lock:
+            row = self.db.execute('SELECT size, mtime, inode, digest FROM digests WHERE path=?',
+                                  (os.path.abspath(path),)).fetchone()
+        if row and tuple(row[:3]) == (stat_info.st_size, stat_info.st_mtime_ns, stat_info.st_ino):
+            return row[3]
+        return None
+
+    def lookup_many(self, keys):
+        """Returns {path: saved digest} for the entries that are up to date,
+        where "keys" is {full path: (size, mtime in ns, inode)} (stat data
+        that is already known, e.g. from a TreeSnapshot). The paths are looked
+        up CACHE_BATCH at a time instead of one query per file.
+        """
+        found = {}
+        paths = list(keys)
+        with self.lock:
+            for start in range(0, len(paths), CACHE_BATCH):
+                batch = paths[start:start + CACHE_BATCH]
+                query = ('SELECT path, size, mtime, inode, digest FROM digests WHERE path IN (%s)' %
+                         ', '.join(['?'] * len(batch)))
+                for (path, size, mtime, inode, digest) in self.db.execute(query, batch):
+                    if (size, mtime, inode) == keys[path]:
+                        found[path] = digest
+        return found
+
+    def store(self, path, stat_info, digest):
+        """Saves (or replaces) the digest of "path" with its current stat data.
+        """
+        with self.lock:
+            self.db.execute('INSERT OR REPLACE INTO digests VALUES (?, ?, ?, ?, ?)',
+                            (os.path.abspath(path), stat_info.st_size,
+                             stat_info.st_mtime_ns, stat_info.st_ino, digest))
+            self.uncommitted += 1
+            if self.uncommitted >= CACHE_COMMIT:
+                self.db.commit()
+                self.uncommitted = 0
+
+    def close(self):
+        """Writes any pending entries and closes the database.
+        """
+        with self.lock:
+            self.db.commit()
+            self.db.close()
+
+class CompareEngine:
+    """Compares file contents with a bounded pool of worker threads.
+
+    Reads from the left and right sides have separate concurrency limits
+    so two different devices (RAID and backup drive, for example) can
+    both be kept busy. Results are reported like filecmp.cmpfiles:
+    (match, mismatch, errors) lists of file names.
+
+    If a DigestCache is passed, digests are computed while files are read
+    and saved. Files whose stat data has not changed since then are
+    compared by digest without being read.
+
+    Files are compared in tiers like tiered_cmp (sizes, sampled blocks,
+    whole files). With "quick" True, the whole-file tier is skipped.
+
+    Usage: engine = CompareEngine(left_workers, right_workers, [cache], [quick])
+           pending = engine.submit(left_dir, right_dir, names)
+           (match, mismatch, errors) = engine.collect(pending)
+           engine.close()
+    """
+    def __init__(self, left_workers=4, right_workers=4, cache=None, quick=False, bufsize=BUFSIZE):
+        self.cache = cache
+        self.quick = quick
+        self.count_lock = threading.Lock()
+        self.files_compared = 0
+        self.bytes_compared = 0
+        self.stats = None   # set to a RunStats to time each file and show progress
+        self.left_gate = ReadGate(left_workers)
+        self.right_gate = ReadGate(right_workers)
+        self.bufsize = bufsize
+        self.pool = ThreadPoolExecutor(max_workers=max(1, left_workers) + max(1, right_workers))
+
+    def run(self, folder, name, func, *args):
+        """Calls func(*args) for file "name" in "folder" and records how long
+        it took and the file size in self.stats (if set). Every file the
+        engine reads or looks up goes through here, so progress covers all
+        the phases of a run.
+        """
+        if self.stats is None:
+            return func(*args)
+        start = time.time()
+        try:
+            return func(*args)
+        finally:
+            try:
+                size = os.stat(os.path.join(folder, name)).st_size
+            except OSError:
+                size = 0
+            self.stats.file_done(folder, name, start, time.time(), size)
+            self.stats.show_progress(self)
+
+    def submit_digest(self, file_path, gate=None):
+        """Queues digest(file_path, gate) on the pool (timed like the
+        comparisons). Returns a future.
+        """
+        return self.pool.submit(self.run, os.path.dirname(file_path), os.path.basename(file_path),
+                                self.digest, file_path, gate)
+
+    def count(self, size):
+        """Adds one file of "size" bytes to the comparison totals.
+        """
+        with self.count_lock:
+            self.files_compared += 1
+            self.bytes_compared += size
+
+    def compare_file(self, left_file, right_file):
+        """Returns True if both files are regular files with identical contents.
+        The per-side read gates are only held while a block is being read.
+        """
+        left_stat = os.stat(left_file)
+        right_stat = os.stat(right_file)
+        if not (stat.S_ISREG(left_stat.st_mode) and stat.S_ISREG(right_stat.st_mode)):
+            return False
+        if left_stat.st_size != right_stat.st_size:
+            return False
+        self.count(left_stat.st_size)
+
+        # use saved digests where possible and only read the files without one
+        left_digest = right_digest = None
+        if self.cache is not None:
+            left_digest = self.cache.lookup(left_file, left_stat)
+            right_digest = self.cache.lookup(right_file, right_stat)
+            if left_digest is not None and right_digest is not None:
+                return left_digest == right_digest
+
+        # sampled blocks find most differences in large files without reading them
+        if left_stat.st_size >= SAMPLE_MIN or self.quick:
+            if not samples_match(left_file, right_file, left_stat.st_size,
+                                 self.left_gate, self.right_gate):
+                return False
+            if self.quick:
+                return True
+        if left_digest is None and right_digest is None:
+            return self.compare_contents(left_file, right_file, left_stat, right_stat)
+        if left_digest is None:
+            left_digest = self.file_digest(left_file, left_stat, self.left_gate)
+        if right_digest is None:
+            right_digest = self.file_digest(right_file, right_stat, self.right_gate)
+        return left_digest == right_digest
+
+    def compare_contents(self, left_file, right_file, left_stat, right_stat):
+        """Reads both files block by block and returns True if identical.
+        Digests are saved to the cache (if any) when both files are read in full.
+        """
+        if self.cache is None:
+            return contents_match(left_file, right_file, self.left_gate, self.right_gate, self.bufsize)
+        left_hash, right_hash = new_hash(), new_hash()
+        if not contents_match(left_file, right_file, self.left_gate, self.right_gate,
+                              self.bufsize, left_hash, right_hash):
+            return False
+        self.save_digest(left_file, left_stat, left_hash.hexdigest())
+        self.save_digest(right_file, right_stat, right_hash.hexdigest())
+        return True
+
+    def file_digest(self, file_path, stat_info, gate, gunzip=False):
+        """Reads one file (holding "gate" for each block) and returns its digest.
+        If "gunzip" is True, the digest is of the decompressed contents.
+        """
+        file_hash = new_hash()
+        with (gzip.open(file_path) if gunzip else open(file_path, 'rb')) as file_obj:
+            while True:
+                block = gate.read(file_obj, self.bufsize)
+                if not block:
+                    break
+                file_hash.update(block)
+        digest = file_hash.hexdigest()
+        self.save_digest(file_path, stat_info, digest, gunzip)
+        return digest
+
+    def save_digest(self, file_path, stat_info, digest, gunzip=False):
+        """Saves a digest unless the file changed while it was being read.
+        """
+        if self.cache is None:
+            return
+        now = os.stat(file_path)
+        if (now.st_size, now.st_mtime_ns, now.st_ino) == (stat_info.st_size,
+                                                         stat_info.st_mtime_ns, stat_info.st_ino):
+            self.cache.store(file_path + (GUNZIP_KEY if gunzip else ''), stat_info, digest)
+
+    def digest(self, file_path, gate=None, gunzip=False):
+        """Returns the digest of one file (None if not a regular file).
+        A saved digest is used if the file has not changed. If "gunzip"
+        is True, the digest is of the decompressed contents.
+        """
+        stat_info = os.stat(file_path)
+        if not stat.S_ISREG(stat_info.st_mode):
+            return None
+        digest = None
+        if self.cache is not None:
+            digest = self.cache.lookup(file_path + (GUNZIP_KEY if gunzip else ''), stat_info)
+        if digest is None:
+            digest = self.file_digest(file_path, stat_info, gate or self.left_gate, gunzip)
+        return digest
+
+    def compare_gzip(self, plain_file, gz_file, plain_gate, gz_gate):
+        """Returns True if "gz_file" decompresses to the contents of "plain_file".
+
+        The uncompressed size in the gzip trailer (ISIZE) is checked first so
+        most differences are found without decompressing. The data is then
+        compared as a stream (no temporary files); the gzip module checks the
+        trailer CRC when it reaches the end. A corrupt gzip file is a mismatch.
+        """
+        plain_stat = os.stat(plain_file)
+        gz_stat = os.stat(gz_file)
+        if not (stat.S_ISREG(plain_stat.st_mode) and stat.S_ISREG(gz_stat.st_mode)):
+            return False
+        if gz_stat.st_size < 18:
+            return False    # too short to be a gzip file
+        with gz_gate:
+            isize = gzip_isize(gz_file)
+        if isize != plain_stat.st_size % 2**32:
+            return False
+        self.count(plain_stat.st_size)
+        if self.cache is not None:
+            plain_digest = self.cache.lookup(plain_file, plain_stat)
+            gz_digest = self.cache.lookup(gz_file + GUNZIP_KEY, gz_stat)
+            if plain_digest is not None and gz_digest is not None:
+                return plain_digest == gz_digest
+
+        plain_hash, gz_hash = new_hash(), new_hash()
+        try:
+            with open(plain_file, 'rb') as plain_obj, gzip.open(gz_file) as gz_obj:
+                while True:
+                    plain_block = plain_gate.read(plain_obj, self.bufsize)
+                    gz_block = gz_gate.read(gz_obj, len(plain_block) or 1)
+                    if plain_block != gz_block:
+                        return False
+                    if not plain_block:
+                        break
+                    if self.cache is not None:
+                        plain_hash.update(plain_block)
+                        gz_hash.update(gz_block)
+        except (EOFError, zlib.error, gzip.BadGzipFile):
+            return False
+        if self.cache is not None:
+            self.save_digest(plain_file, plain_stat, plain_hash.hexdigest())
+            self.save_digest(gz_file, gz_stat, gz_hash.hexdigest(), gunzip=True)
+        return True
+
+    def verify_file(self, file_path, expected, gunzip=False):
+        """Returns True if the digest of "file_path" equals "expected".
+        """
+        digest = self.digest(file_path, gunzip=gunzip)
+        self.count(os.path.getsize(file_path))
+        return digest == expected
+
+    def chunk_digests(self, file_path, chunk_size=MANIFEST_CHUNK):
+        """Reads one file and returns (stat, digest, chunk_digests).
+        "chunk_digests" is a list with one digest per "chunk_size" block,
+        or an empty list if the file fits in a single block.
+        """
+        stat_info = os.stat(file_path)
+        file_hash, chunk_hash = new_hash(), new_hash()
+        chunks, chunk_fill = [], 0
+        with open(file_path, 'rb') as file_obj:
+            while True:
+                block = self.left_gate.read(file_obj, min(self.bufsize, chunk_size - chunk_fill))
+                if not block:
+                    break
+                file_hash.update(block)
+                chunk_hash.update(block)
+                chunk_fill += len(block)
+                if chunk_fill == chunk_size:
+                    chunks.append(chunk_hash.hexdigest())
+                    chunk_hash, chunk_fill = new_hash(), 0
+        if chunk_fill:
+            chunks.append(chunk_hash.hexdigest())
+        digest = file_hash.hexdigest()
+        if self.cache is not None:
+            self.save_digest(file_path, stat_info, digest)
+        return stat_info, digest, (chunks if len(chunks) > 1 else [])
+
+    def submit_expected(self, left_dir, names, expected):
+        """Queues checks of files "names" in "left_dir" against the digests
+        in the "expected" dictionary (name: digest). Returns pending jobs
+        for collect().
+        """
+        return [(name, self.pool.submit(self.run, left_dir, name, self.verify_file,
+                                        os.path.join(left_dir, name), expected[name]))
+                for name in names]
+
+    def submit_gzip(self, left_dir, right_dir, pairs, expected=None):
+        """Queues comparisons of (left_name, right_name) pairs where one name
+        is the other plus '.gz' (see pair_gzip). If "expected" (name: digest)
+        is given, the right side is a manifest and only pairs with the .gz
+        file on the left can be checked. Returns pending jobs for collect().
+        """
+        jobs = []
+        for left_name, right_name in pairs:
+            label = '%s <> %s' % (left_name, right_name)
+            left_file = os.path.join(left_dir, left_name)
+            if expected is not None:
+                future = self.pool.submit(self.run, left_dir, left_name, self.verify_file,
+                                          left_file, expected.get(right_name), True)
+            elif left_name.endswith('.gz'):
+                future = self.pool.submit(self.run, left_dir, left_name, self.compare_gzip,
+                                          os.path.join(right_dir, right_name), left_file,
+                                          self.right_gate, self.left_gate)
+            else:
+                future = self.pool.submit(self.run, left_dir, left_name, self.compare_gzip,
+                                          left_file, os.path.join(right_dir, right_name),
+                                          self.left_gate, self.right_gate)
+            jobs.append((label, future))
+        return jobs
+
+    def submit(self, left_dir, right_dir, names):
+        """Queues comparisons of files "names" (common to both folders).
+        Returns a list of (name, future) pairs to pass to collect().
+        """
+        return [(name, self.pool.submit(self.run, left_dir, name, self.compare_file,
+                                        os.path.join(left_dir, name),
+                                        os.path.join(right_dir, name)))
+                for name in names]
+
+    def collect(self, pending):
+        """Waits for queued comparisons and returns (match, mismatch, errors).
+        """
+        match, mismatch, errors = [], [], []
+        for name, future in pending:
+            try:
+                if future.result():
+                    match.append(name)
+                else:
+                    mismatch.append(name)
+            except OSError:
+                errors.append(name)
+        return match, mismatch, errors
+
+    def cmpfiles(self, left_dir, right_dir, names):
+        """Drop-in replacement for filecmp.cmpfiles(..., shallow=False).
+        """
+        return self.collect(self.submit(left_dir, right_dir, names))
+
+    def close(self):
+        """Waits for any queued work and stops the worker threads.
+        """
+        self.pool.shutdown(wait=True)
+
+# entry kinds in a TreeSnapshot folder listing
+FILE = 'f'
+FOLDER = 'd'
+OTHER = 'o'
+
+class TreeSnapshot:
+    """Listing of a whole folder tree made in one pass with os.scandir.
+
+    Each folder is stored once as a compact row: a tuple of sorted entry
+    names, a string of entry kinds (FILE, FOLDER, or OTHER), and integer
+    arrays of sizes and modification times (nanoseconds). Folder sizes and
+    times are not looked up. Folders are kept in top-down walk order and
+    keyed on their path relative to "top" ('' is the top folder). Folders
+    that could not be listed hold the OSError instead of a row. With
+    "inodes" True, the files' inodes (file index on Windows) are kept too,
+    in a matching array for each folder in self.inodes (0 for other
+    entries), so saved digests can be checked without another stat call
+    (see cached_digests). They come with the listing on Linux; Windows
+    needs one extra call per file.
+
+    Usage: snapshot = TreeSnapshot(top, [inodes])
+           (names, kinds, sizes, mtimes) = snapshot.folders[relative_path]
+    """
+    def __init__(self, top, inodes=False):
+        self.top = top
+        self.folders = {}
+        self.inodes = {} if inodes else None
+        self.scan()
+
+    def path(self, folder):
+        """Returns the full path of a relative folder path.
+        """
+        return os.path.join(self.top, folder) if folder else self.top
+
+    def scan(self):
+        """Walks the tree (top-down, sorted names) and fills in self.folders.
+        Symbolic links to folders are listed but not followed (like os.walk).
+        """
+        stack = ['']
+        while stack:
+            folder = stack.pop()
+            try:
+                with os.scandir(self.path(folder)) as listing:
+                    entries = sorted(listing, key=lambda entry: entry.name)
+            except OSError as e:
+                self.folders[folder] = e
+                continue
+            names, kinds, sizes, mtimes, inodes = [], [], array('q'), array('q'), array('Q')
+            subfolders = []
+            for entry in entries:
+                size = mtime = inode = 0
+                try:
+                    if entry.is_dir():
+                        kind = FOLDER
+                        if not entry.is_symlink():
+                            subfolders.append(os.path.join(folder, entry.name))
+                    elif entry.is_file():
+                        kind = FILE
+                        stat_info = entry.stat()
+                        size, mtime = stat_info.st_size, stat_info.st_mtime_ns
+                        if self.inodes is not None:
+                            inode = stat_info.st_ino or entry.inode()   # 0 in Windows listings
+                    else:
+                        kind = OTHER
+                except OSError:
+                    kind = OTHER
+                names.append(entry.name)
+                kinds.append(kind)
+                sizes.append(size)
+                mtimes.append(mtime)
+                inodes.append(inode)
+            self.folders[folder] = (tuple(names), ''.join(kinds), sizes, mtimes)
+            if self.inodes is not None:
+                self.inodes[folder] = inodes
+            stack.extend(reversed(subfolders))
+
+def diff_snapshots(left_snapshot, right_snapshot, same=()):
+    """Compares two TreeSnapshots folder by folder in the left walk order.
+
+    Yields (folder, differences, common, changed, error) for each left
+    folder that also exists on the right. "differences" is a dictionary
+    of name lists like filecmp.dircmp: left_only, right_only, common_funny
+    (different kinds on each side), diff_files (files of different sizes)
+    and funny_files (neither file nor folder on both sides). "common" are
+    the files with the same size on both sides and "changed" are those
+    that also have different modification times. "error" is an OSError
+    if either folder could not be listed (the other values are then empty).
+    Folders inside left_only folders are skipped since the parent already
+    reports them. Folders in "same" (known to be identical, see
+    folder_digests) and everything below them are not compared and are
+    yielded with no differences.
+    """
+    same_folders = set()
+    for folder, left_row in left_snapshot.folders.items():
+        right_row = right_snapshot.folders.get(folder)
+        if right_row is None:
+            continue
+        if folder in same or (folder and os.path.dirname(folder) in same_folders):
+            same_folders.add(folder)
+            yield folder, {'left_only': [], 'right_only': [], 'common_funny': [],
+                           'diff_files': [], 'funny_files': []}, [], [], None
+            continue
+        error = None
+        if isinstance(left_row, OSError):
+            error = left_row
+        elif isinstance(right_row, OSError):
+            error = right_row
+        if error:
+            yield folder, {}, [], [], error
+            continue
+
+        (left_names, left_kinds, left_sizes, left_mtimes) = left_row
+        (right_names, right_kinds, right_sizes, right_mtimes) = right_row
+        right_index = {name: i for i, name in enumerate(right_names)}
+        differences = {'left_only': [], 'right_only': [], 'common_funny': [],
+                       'diff_files': [], 'funny_files': []}
+        common, changed = [], []
+        for i, name in enumerate(left_names):
+            j = right_index.pop(name, None)
+            if j is None:
+                differences['left_only'].append(name)
+            elif left_kinds[i] != right_kinds[j]:
+                differences['common_funny'].append(name)
+            elif left_kinds[i] == OTHER:
+                differences['funny_files'].append(name)
+            elif left_kinds[i] == FILE:
+                if left_sizes[i] != right_sizes[j]:
+                    differences['diff_files'].append(name)
+                else:
+                    common.append(name)
+                    if left_mtimes[i] != right_mtimes[j]:
+                        changed.append(name)
+        differences['right_only'] = sorted(right_index)
+        yield folder, differences, common, changed, None
+
+def compared_bytes(left_snapshot, right_snapshot=None):
+    """Returns the size of the left tree's files that diff_snapshots gets to:
+    those in folders listed on both sides (every listed left folder if
+    "right_snapshot" is None, e.g. for a manifest export). Files in folders
+    that are only on the left, or that could not be listed, are not compared.
+    """
+    total = 0
+    for folder, row in left_snapshot.folders.items():
+        if isinstance(row, OSError):
+            continue
+        if right_snapshot is not None:
+            right_row = right_snapshot.folders.get(folder)
+            if right_row is None or isinstance(right_row, OSError):
+                continue
+        total += sum(row[2])
+    return total
+
+def only_files(snapshot, folder, names):
+    """Yields (entry, relative path, size) for the files in "names" (entries
+    of "folder") and for every file below the ones that are folders.
+    "entry" is the relative path of the listed name the file belongs to.
+    """
+    row = snapshot.folders.get(folder)
+    if not row or isinstance(row, OSError):
+        return
+    index = {name: i for i, name in enumerate(row[0])}
+    for name in names:
+        entry = os.path.join(folder, name)
+        i = index[name]
+        if row[1][i] == FILE:
+            yield entry, entry, row[2][i]
+        elif row[1][i] == FOLDER:
+            below = [entry]
+            while below:
+                subfolder = below.pop()
+                sub_row = snapshot.folders.get(subfolder)
+                if not sub_row or isinstance(sub_row, OSError):
+                    continue
+                for sub_name, kind, size in zip(sub_row[0], sub_row[1], sub_row[2]):
+                    if kind == FILE:
+                        yield entry, os.path.join(subfolder, sub_name), size
+                    elif kind == FOLDER:
+                        below.append(os.path.join(subfolder, sub_name))
+
+def find_moves(left_snapshot, right_snapshot, engine, folder_differences, ignore=None):
+    """Finds files that were moved or renamed between two snapshots.
+
+    "folder_differences" is the list of diff_snapshots() results for the
+    two snapshots. Files that are only on the left (including files inside
+    left_only folders) are matched to files only on the right: first by
+    size, then by content digest. Only files with a size found on both
+    sides are hashed. Empty files have no contents to match, so they are
+    paired on file name instead (a moved empty file; renamed ones are not
+    found). If the right side is a ManifestSnapshot, its saved digests are
+    used. Each file is used in at most one pair. Returns (pairs,
+    left_moved, right_moved) where "pairs" is a sorted list of (left
+    relative path, right relative path) and the other two are sets of
+    left_only/right_only entries (relative paths) whose files were all
+    matched.
+    """
+    left_sizes, right_sizes = {}, {}
+    left_entries, right_entries = {}, {}
+    for (folder, differences, common, changed, error) in folder_differences:
+        for (snapshot, title, sizes, entries) in [(left_snapshot, 'left_only', left_sizes, left_entries),
+                                                  (right_snapshot, 'right_only', right_sizes, right_entries)]:
+            names = [x for x in differences.get(title, []) if not (ignore and ignore(x))]
+            for entry, relative, size in only_files(snapshot, folder, names):
+                if not (ignore and ignore(os.path.basename(relative))):
+                    entries.setdefault(entry, set()).add(relative)
+                    sizes.setdefault(size, []).append(relative)
+
+    # empty files are paired by name
+    pairs = []
+    right_empty = {}
+    for relative in right_sizes.pop(0, []):
+        right_empty.setdefault(os.path.basename(relative), []).append(relative)
+    for relative in left_sizes.pop(0, []):
+        if right_empty.get(os.path.basename(relative)):
+            pairs.append((relative, right_empty[os.path.basename(relative)].pop(0)))
+
+    # hash only the files with a matching size on the other side
+    # (right side files, and left files in folders that are not compared, are
+    # extra work on top of the compared left folders for progress)
+    left_jobs, right_jobs = [], []
+    right_by_digest = {}
+    sizes = sorted(set(left_sizes) & set(right_sizes))
+    if engine.stats is not None:
+        compared = {folder for (folder, differences, common, changed, error) in folder_differences
+                    if not error}
+        extra = sum(size for size in sizes for relative in left_sizes[size]
+                    if os.path.dirname(relative) not in compared)
+        if not isinstance(right_snapshot, ManifestSnapshot):
+            extra += sum(size * len(right_sizes[size]) for size in sizes)
+        engine.stats.add_work(extra)
+    for size in sizes:
+        for relative in left_sizes[size]:
+            left_jobs.append((relative, engine.submit_digest(os.path.join(left_snapshot.top, relative),
+                                                             engine.left_gate)))
+        for relative in right_sizes[size]:
+            if isinstance(right_snapshot, ManifestSnapshot):
+                (folder, name) = os.path.split(relative)
+                digest = right_snapshot.digests.get(folder, {}).get(name)
+                right_by_digest.setdefault(digest, []).append(relative)
+            else:
+                right_jobs.append((relative, engine.submit_digest(os.path.join(right_snapshot.top, relative),
+                                                                  engine.right_gate)))
+    for relative, future in right_jobs:
+        try:
+            right_by_digest.setdefault(future.result(), []).append(relative)
+        except OSError:
+            pass
+    right_by_digest.pop(None, None)
+    for relative, future in left_jobs:
+        try:
+            digest = future.result()
+        except OSError:
+            continue
+        if right_by_digest.get(digest):
+            pairs.append((relative, right_by_digest[digest].pop(0)))
+    pairs.sort()
+
+    # entries are "moved" when every file in them was paired
+    left_paired = {left_file for left_file, right_file in pairs}
+    right_paired = {right_file for left_file, right_file in pairs}
+    left_moved = {entry for entry, files in left_entries.items() if files <= left_paired}
+    right_moved = {entry for entry, files in right_entries.items() if files <= right_paired}
+    return pairs, left_moved, right_moved
+
+def gzip_isize(gz_path):
+    """Returns ISIZE from the gzip trailer (the last 4 bytes of the file):
+    the uncompressed size modulo 2**32 (of the last member for multi-member
+    files; Project_archiver.py writes single-member files). The trailer CRC
+    is not needed since gzip checks it when the data is read.
+    """
+    with open(gz_path, 'rb') as gz_obj:
+        gz_obj.seek(-4, os.SEEK_END)
+        return struct.unpack('<I', gz_obj.read(4))[0]
+
+def pair_gzip(differences, right_is_manifest=False):
+    """Pairs left_only and right_only names where one is the other plus '.gz'
+    (an archived copy). Paired names are removed from the differences
+    lists in place. If the right side is a manifest, only .gz files on the
+    left can be paired. Returns a list of (left_name, right_name) pairs.
+    """
+    left_only = set(differences['left_only'])
+    right_only = set(differences['right_only'])
+    pairs = []
+    for name in differences['left_only']:
+        if name + '.gz' in right_only and not right_is_manifest:
+            pairs.append((name, name + '.gz'))
+        elif name.endswith('.gz') and name[:-3] in right_only:
+            pairs.append((name, name[:-3]))
+    for left_name, right_name in pairs:
+        left_only.discard(left_name)
+        right_only.discard(right_name)
+    differences['left_only'] = [x for x in differences['left_only'] if x in left_only]
+    differences['right_only'] = [x for x in differences['right_only'] if x in right_only]
+    return pairs
+
+def folder_digests(snapshot, file_digests, ignore=None):
+    """Builds Merkle digests for every folder in a TreeSnapshot.
+
+    A folder digest is the hash of its sorted (kind, name, digest) entries,
+    where files use their content digests (from "file_digests", given as
+    {folder: {name: digest}} or as a function(folder, name) like the one
+    from cached_digests) and subfolders use their own folder digests.
+    Two folders with equal digests have identical names and contents all
+    the way down. "ignore" is an optional function that returns True for
+    names to leave out. Folders with anything that could not be read
+    get None. Returns {folder: digest}.
+    """
+    tree = {}
+    for folder in reversed(list(snapshot.folders)):   # children before parents
+        row = snapshot.folders[folder]
+        if isinstance(row, OSError):
+            tree[folder] = None
+            continue
+        folder_hash = new_hash()
+        if not callable(file_digests):
+            digests = file_digests.get(folder, {})
+        for name, kind in zip(row[0], row[1]):
+            if ignore and ignore(name):
+                continue
+            if kind == FILE:
+                digest = file_digests(folder, name) if callable(file_digests) else digests.get(name)
+            elif kind == FOLDER:
+                digest = tree.get(os.path.join(folder, name), '')  # linked folders are not walked
+            else:
+                digest = ''
+            if digest is None:
+                folder_hash = None
+                break
+            folder_hash.update(('%s\t%s\t%s\n' % (kind, name, digest)).encode('utf-8'))
+        tree[folder] = folder_hash.hexdigest() if folder_hash else None
+    return tree
+
+def cached_digests(snapshot, cache):
+    """Returns a function(folder, name) for folder_digests that gives the
+    saved digest of a file in a TreeSnapshot (None if there is no current
+    entry). The stat data comes from the snapshot (made with inodes=True)
+    and a folder's digests are looked up together the first time one of
+    its files is asked for (folder_digests goes one folder at a time), so
+    there are no stat calls and one query per folder. File contents are
+    never read, so folders with new or changed files simply get no digest
+    and are compared file by file.
+    """
+    current = {}    # {folder: {name: digest}} for the folder being looked up
+    def lookup(folder, name):
+        if folder not in current:
+            current.clear()
+            current[folder] = digests = {}
+            row = snapshot.folders.get(folder)
+            inodes = snapshot.inodes.get(folder) if snapshot.inodes is not None else None
+            if row is not None and not isinstance(row, OSError) and inodes is not None:
+                folder_path = os.path.abspath(snapshot.path(folder))
+                keys = {}
+                for (file_name, kind, size, mtime, inode) in zip(row[0], row[1], row[2], row[3], inodes):
+                    if kind == FILE:
+                        keys[os.path.join(folder_path, file_name)] = (size, mtime, inode)
+                for path, digest in cache.lookup_many(keys).items():
+                    digests[os.path.basename(path)] = digest
+        return current[folder].get(name)
+    return lookup
+
+def same_folders(left_tree, right_tree):
+    """Returns the set of folders with equal (known) digests in both trees.
+    """
+    return {folder for folder, digest in left_tree.items()
+            if digest is not None and digest == right_tree.get(folder)}
+
+def open_manifest(manifest_path, mode='r'):
+    """Opens a manifest file as text (gzip compressed if name ends in .gz).
+    """
+    if manifest_path.lower().endswith('.gz'):
+        return gzip.open(manifest_path, mode + 't', encoding='utf-8', newline='\n')
+    return open(manifest_path, mode, encoding='utf-8', newline='\n')
+
+def write_manifest(snapshot, manifest_path, engine, window=64):
+    """Writes a manifest of every folder and file in a TreeSnapshot.
+
+    The manifest is a tab-delimited text file with a header line and then
+    one line per entry in walk order: kind, relative path ('/' separators),
+    size, modification time (ns), content digest, and comma-separated
+    chunk digests (MANIFEST_CHUNK blocks; empty for single-block files).
+    Files are hashed on the engine's thread pool and lines are written
+    as soon as they are ready. The Merkle digests of all folders (see
+    folder_digests) are added at the end as "m" lines. Files that could
+    not be read are listed with their snapshot size and time and an empty
+    digest (their folders get no "m" line).
+    Returns (number of files, total bytes, [(relative path, error)]).
+    """
+    def write_ready(keep):
+        while len(pending) > keep:
+            (folder, name, relative, size, mtime, future) = pending.popleft()
+            try:
+                stat_info, digest, chunks = future.result()
+            except OSError as e:
+                errors.append((relative, e))
+                file_digests.setdefault(folder, {})[name] = None
+                print(FILE, relative, size, mtime, '', '', sep='\t', file=manifest)
+                continue
+            file_digests.setdefault(folder, {})[name] = digest
+            print(FILE, relative, stat_info.st_size, stat_info.st_mtime_ns, digest,
+                  ','.join(chunks), sep='\t', file=manifest)
+            totals[0] += 1
+            totals[1] += stat_info.st_size
+
+    totals = [0, 0]
+    errors = []
+    file_digests = {}
+    pending = collections.deque()
+    with open_manifest(manifest_path, 'w') as manifest:
+        print('#manifest', 'v1', HASH_NAME, MANIFEST_CHUNK, snapshot.top, time.ctime(),
+              sep='\t', file=manifest)
+        for folder, row in snapshot.folders.items():
+            if isinstance(row, OSError):
+                continue
+            (names, kinds, sizes, mtimes) = row
+            for name, kind, size, mtime in zip(names, kinds, sizes, mtimes):
+                relative = os.path.join(folder, name).replace(os.sep, '/')
+                if '\t' in relative or '\n' in relative:
+                    continue    # can not be stored in a tab-delimited line
+                if kind == FILE:
+                    future = engine.pool.submit(engine.run, snapshot.path(folder), name, engine.chunk_digests,
+                                                os.path.join(snapshot.path(folder), name))
+                    pending.append((folder, name, relative, size, mtime, future))
+                else:
+                    write_ready(0)
+                    print(kind, relative, 0, 0, '', '', sep='\t', file=manifest)
+                write_ready(window)
+        write_ready(0)
+        for folder, digest in folder_digests(snapshot, file_digests).items():
+            if digest:
+                print('m', folder.replace(os.sep, '/'), 0, 0, digest, '', sep='\t', file=manifest)
+    return totals[0], totals[1], errors
+
+class ManifestSnapshot(TreeSnapshot):
+    """TreeSnapshot read from a manifest file instead of a live tree.
+
+    The folders are rebuilt from the manifest lines so diff_snapshots()
+    works the same way. File digests are kept in self.digests as
+    {folder: {name: digest}} (None for files that could not be read when
+    the manifest was written) and the folder (Merkle) digests in self.tree.
+    The chunk digests are left in the file; they are not needed to verify.
+    """
+    def __init__(self, manifest_path):
+        self.top = manifest_path
+        self.folders = {}
+        self.inodes = None
+        self.digests = {}
+        self.tree = {}
+        self.read(manifest_path)
+        if not self.tree:
+            self.tree = folder_digests(self, self.digests)
+
+    def path(self, folder):
+        """Returns a printable location for a relative folder path.
+        """
+        return '%s:%s' % (self.top, folder) if folder else self.top
+
+    def read(self, manifest_path):
+        """Streams the manifest lines into folder rows.
+        """
+        rows = {'': ([], [], array('q'), array('q'))}
+        with open_manifest(manifest_path) as manifest:
+            header = manifest.readline().rstrip('\n').split('\t')
+            if header[0] != '#manifest' or header[2] != HASH_NAME:
+                raise ValueError('%s is not a %s manifest file' % (manifest_path, HASH_NAME))
+            for line in manifest:
+                (kind, relative, size, mtime, digest, chunks) = line.rstrip('\n').split('\t')
+                if kind == 'm':
+                    self.tree[relative.replace('/', os.sep)] = digest
+                    continue
+                (folder, name) = os.path.split(relative.replace('/', os.sep))
+                if kind == FOLDER:
+                    rows.setdefault(os.path.join(folder, name), ([], [], array('q'), array('q')))
+                row = rows.setdefault(folder, ([], [], array('q'), array('q')))
+                row[0].append(name)
+                row[1].append(kind)
+                row[2].append(int(size))
+                row[3].append(int(mtime))
+                if kind == FILE:
+                    self.digests.setdefault(folder, {})[name] = digest or None
+        for folder, (names, kinds, sizes, mtimes) in rows.items():
+            self.folders[folder] = (tuple(names), ''.join(kinds), sizes, mtimes)
+
+class DiffReporter:
+    """Writes differences to a JSONL or CSV file, one record per difference,
+    as they are found (nothing is kept in memory except counts).
+
+    The format is CSV if the file name ends in .csv, otherwise JSON lines.
+    Each record has: kind (left_only, right_only, common_funny, diff_files,
+    funny_files, mismatch, error, moved), left and right folder paths, the
+    file name, and a detail string (the new name for moved files). close()
+    can add a summary record with the count of each kind plus any other
+    totals (kind "summary"; in CSV files one row per total with the name
+    and value in the name/detail columns).
+
+    Usage: reporter = DiffReporter(report_path)
+           reporter.record(kind, left_path, right_path, name, [detail])
+           reporter.close([totals])
+    """
+    FIELDS = ['kind', 'left', 'right', 'name', 'detail']
+
+    def __init__(self, report_path):
+        self.is_csv = report_path.lower().endswith('.csv')
+        self.file_obj = open(report_path, 'w', newline='', encoding='utf-8')
+        self.counts = collections.Counter()
+        if self.is_csv:
+            self.writer = csv.writer(self.file_obj)
+            self.writer.writerow(self.FIELDS)
+
+    def record(self, kind, left_path, right_path, name='', detail=''):
+        """Writes one difference.
+        """
+        self.counts[kind] += 1
+        row = [kind, left_path, right_path, name, str(detail)]
+        if self.is_csv:
+            self.writer.writerow(row)
+        else:
+            print(json.dumps(dict(zip(self.FIELDS, row))), file=self.file_obj)
+
+    def close(self, totals=None):
+        """Writes the summary record (if "totals" is not None) and closes the file.
+        "totals" is a dictionary of extra values, e.g. bytes compared.
+        """
+        if totals is not None:
+            summary = dict(self.counts)
+            summary.update(totals)
+            if self.is_csv:
+                for name, value in summary.items():
+                    self.writer.writerow(['summary', '', '', name, value])
+            else:
+                print(json.dumps({'kind': 'summary', 'totals': summary}), file=self.file_obj)
+        self.file_obj.close()
+
+class RunStats:
+    """Timing and throughput numbers for one comparison run.
+
+    The engine reports every file it reads or looks up, in every phase of
+    a run, with the time taken and the file size (CompareEngine.stats).
+    The script reports each folder when it is finished along with the
+    bytes of the left tree it holds; only the bytes the engine did not
+    already count (files that did not need checking) are added then. The
+    total should only hold folders that will be reported (see
+    compared_bytes), plus any extra reads (add_work).
+    From these, the progress, rate, and time left are worked out, and the
+    slowest folders (wall time from the first file started to the last
+    one finished) and slowest files are kept. Progress lines are passed
+    to "show" (e.g. print) at most every "interval" seconds.
+
+    Usage: stats = RunStats(total_bytes, [slowest], [interval], [show])
+           engine.stats = stats
+           stats.add_work(extra_bytes)    # work beyond the left tree
+           stats.folder_done(folder, folder_bytes)
+           stats.show_progress(engine)
+           record = stats.summary(engine)
+    """
+    def __init__(self, total_bytes, slowest=10, interval=10.0, show=None):
+        self.start = time.time()
+        self.total_bytes = total_bytes
+        self.done_bytes = 0
+        self.files_done = 0
+        self.folders_done = 0
+        self.slowest = slowest
+        self.interval = interval
+        self.show = show
+        self.last_progress = self.start
+        self.lock = threading.Lock()
+        self.show_lock = threading.Lock()   # one progress line at a time
+        self.folder_times = {}
+        self.folder_bytes = {}    # bytes counted by the engine in each folder
+        self.slow_files = []      # heaps of (seconds, path)
+        self.slow_folders = []
+
+    def keep_slowest(self, heap, seconds, path):
+        """Adds an item to a "slowest" heap, keeping only the top entries.
+        """
+        if len(heap) < self.slowest:
+            heapq.heappush(heap, (seconds, path))
+        elif seconds > heap[0][0]:
+            heapq.heapreplace(heap, (seconds, path))
+
+    def file_done(self, folder, name, start, end, size=0):
+        """Records the time taken by one file of "size" bytes (called from
+        worker threads).
+        """
+        with self.lock:
+            self.keep_slowest(self.slow_files, end - start, os.path.join(folder, name))
+            (first, last) = self.folder_times.get(folder, (start, end))
+            self.folder_times[folder] = (min(first, start), max(last, end))
+            self.folder_bytes[folder] = self.folder_bytes.get(folder, 0) + size
+            self.done_bytes += size
+            self.files_done += 1
+
+    def add_work(self, size):
+        """Adds bytes that will be read on top of the left tree.
+        """
+        with self.lock:
+            self.total_bytes += size
+
+    def folder_done(self, folder, folder_bytes):
+        """Records a finished folder and the bytes of files it holds.
+        """
+        with self.lock:
+            (first, last) = self.folder_times.pop(folder, (0.0, 0.0))
+            self.keep_slowest(self.slow_folders, last - first, folder)
+            self.done_bytes += max(0, folder_bytes - self.folder_bytes.pop(folder, 0))
+            self.folders_done += 1
+
+    def show_progress(self, engine):
+        """Passes a progress line to self.show if it is time for a new one.
+        """
+        if self.show is not None:
+            with self.show_lock:
+                line = self.progress(engine)
+                if line:
+                    self.show(line)
+
+    def progress(self, engine, force=False):
+        """Returns a progress line with rates and time left (ETA), or None
+        if the last line was less than "interval" seconds ago.
+        """
+        now = time.time()
+        with self.lock:
+            if not force and now - self.last_progress < self.interval:
+                return None
+            self.last_progress = now
+        elapsed = max(now - self.start, 1e-6)
+        fraction = min(1.0, self.done_bytes / self.total_bytes) if self.total_bytes else 1.0
+        if fraction > 0:
+            eta = format_seconds(elapsed * (1.0 - fraction) / fraction)
+        else:
+            eta = '?'
+        return ('...%5.1f%% of %s, %s files (%0.1f/s), left %0.1f MB/s, right %0.1f MB/s, ETA %s' %
+                (100.0 * fraction, format_bytes(self.total_bytes), self.files_done,
+                 self.files_done / elapsed, engine.left_gate.bytes_read / elapsed / 1048576.0,
+                 engine.right_gate.bytes_read / elapsed / 1048576.0, eta))
+
+    def summary(self, engine):
+        """Returns a dictionary of the run totals, rates, and slowest items.
+        """
+        elapsed = max(time.time() - self.start, 1e-6)
+        return {'seconds': round(elapsed, 3),
+                'folders': self.folders_done,
+                'files_checked': self.files_done,
+                'files_compared': engine.files_compared,
+                'bytes_compared': engine.bytes_compared,
+                'files_per_second': round(engine.files_compared / elapsed, 3),
+                'left_bytes_read': engine.left_gate.bytes_read,
+                'right_bytes_read': engine.right_gate.bytes_read,
+                'left_mb_per_second': round(engine.left_gate.bytes_read / elapsed / 1048576.0, 3),
+                'right_mb_per_second': round(engine.right_gate.bytes_read / elapsed / 1048576.0, 3),
+                'slowest_folders': [[round(t, 3), path] for (t, path) in sorted(self.slow_folders, reverse=True)],
+                'slowest_files': [[round(t, 3), path] for (t, path) in sorted(self.slow_files, reverse=True)]}
+
+def format_seconds(seconds):
+    """Formats seconds as H:MM:SS.
+    """
+    seconds = int(seconds)
+    return '%d:%02d:%02d' % (seconds // 3600, (seconds // 60) % 60, seconds % 60)
+
+def format_bytes(size):
+    """Formats a byte count with a sensible unit.
+    """
+    for unit in ['bytes', 'KB', 'MB', 'GB']:
+        if size < 1024.0:
+            return '%0.1f %s' % (size, unit) if unit != 'bytes' else '%d bytes' % size
+        size /= 1024.0
+    return '%0.1f TB' % size
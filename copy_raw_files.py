@@ -4,8 +4,8 @@ Copies Thermo RAW files (and other files) selected by the
 user to a destination folder. A new filder is created if
 needed. Destination will typically be on an external drive.
 File contents are checked to ensure that copies are intact,
-and copies are repeated (user settable limit) until file and
-copy match.
+and bad parts of copies are rewritten (user settable limit)
+until file and copy match.
 
 The MIT License (MIT)
 
@@ -34,25 +34,75 @@ Technology & Research Collaborations, Oregon Health & Science University,
 Ph: 503-494-8200, FAX: 503-494-4729, Email: techmgmt@ohsu.edu.
 
 updated for Python 3 -PW 20171211
+source files are hashed while copying so they are only read once
+copies are flushed to the drive and read back from it (not the OS page cache)
+only the bad chunks of a copy are rewritten instead of recopying the whole file
+interrupted transfers resume from a journal kept in the destination folder
+several files are copied at once (largest first, with per-drive limits)
+files can be copied to more than one destination while being read only once
+copies are reflinks (shared data blocks) where the filesystem supports them
+WATCH mode copies RAW files without dialogs as soon as acquisitions finish
+(files already in the watch folders at start are left alone unless WATCH_EXISTING)
+copies can be limited to a set speed (changeable while running) and a lower I/O priority
+sync: verified files are skipped and existing copies are checked and repaired in place
 """
 # global imports
 import os
-import filecmp
 import sys
-import shutil
 import time
 import string
 import re
-from ctypes import windll
 import tkinter
 from tkinter import filedialog
 
-# how many times to try copying before moving to next file
+# verified copies (needs copy_tools.py and compare_tools.py in the same folder)
+from copy_tools import fan_out_copy, verify_mode, copy_backend, CopyJournal, CopyScheduler, COPY_CHUNK
+from copy_tools import StableFileWatcher, THROTTLE, set_io_priority
+
+# how many times to try rewriting a bad chunk of a copy before moving to next file
 RETRY = 3
 # make extra raw_files folder on destination
 RAW_FOLDER = True
 # test and remove any spaces in file paths
 NO_SPACES = True
+# keep a journal in the destination folder so interrupted transfers can be resumed
+RESUME = True
+# files already at the destination that the journal does not vouch for are checked
+# (and repaired) in place instead of being copied again
+SYNC = True
+# more top-level folders to copy to at the same time (e.g. a local backup drive);
+# each source file is read once and written to all destinations
+EXTRA_DESTINATIONS = []
+# how many files to copy at the same time
+COPY_WORKERS = 4
+# how many files to read at once from each source drive and write to each destination drive
+READ_STREAMS = 2
+WRITE_STREAMS = 2
+# different limits for specific drives, e.g. {'E:\\': 1} for a slow pocket drive
+DEVICE_STREAMS = {}
+# run without dialogs: watch instrument folders and copy RAW files as acquisitions finish
+WATCH = False
+# folders the instrument writes RAW files into (project folders inside them are checked too)
+WATCH_FOLDERS = [r'E:\PSR_data']
+# top-level folder that copies go to (as <project>/raw_files)
+WATCH_DESTINATION = 'G:\\'
+# file types to copy
+WATCH_EXTENSIONS = ['.raw']
+# how many folder levels below the watch folders to look in
+WATCH_DEPTH = 2
+# also copy the RAW files that are already in the watch folders when watching starts
+# (False: only files that appear or change later are copied)
+WATCH_EXISTING = False
+# a RAW file is finished when its size and time have not changed for this many seconds
+STABLE_SECONDS = 120
+# seconds between checks of the watch folders
+POLL_SECONDS = 30
+# limit copy and verification reads to this many MB/s (0 for no limit)
+MAX_MB_PER_SECOND = 0
+# put a number (MB/s, 0 for no limit) in this file to change the limit while copying
+SPEED_FILE = 'copy_raw_files_speed.txt'
+# I/O priority of the copies: 'normal', 'low' or 'idle' (lets the instrument write first)
+IO_PRIORITY = 'normal'
 
 def get_files(default_location, extension_list, title_string=""):
     """Dialog box to browse for files.  Returns a list of file names.
@@ -107,12 +157,262 @@ def get_folder(default_location, title_string=""):
                                    title=title_string, mustexist=False)
     # end
 
+def copy_file(source, destinations, resume_chunks, on_chunks, existing):
+    """Makes verified copies to one or more destinations (called on the copy threads).
+    Destinations listed in "existing" already have a copy that is checked (and
+    repaired) in place instead. The source is read once for all of them.
+    Returns one (ok, digest, repairs) per destination.
+    """
+    return fan_out_copy(source, destinations, RETRY, resume_chunks=resume_chunks,
+                        on_chunks=on_chunks, existing=existing)
+
+def label(i, destination_folders):
+    """Destination folder tag for log lines (only when there is more than one).
+    """
+    return ' -> %s' % destination_folders[i] if len(destination_folders) > 1 else ''
+
+def log_speed_changes(obj_list):
+    """Logs any changes to the speed limit made with SPEED_FILE.
+    """
+    for (when, mb_per_second) in THROTTLE.pop_changes():
+        for obj in obj_list:
+            if mb_per_second:
+                print('...SPEED LIMIT CHANGED to %s MB/s on %s' % (mb_per_second, when), file=obj)
+            else:
+                print('...SPEED LIMIT REMOVED on %s' % when, file=obj)
+
+def project_name(raw_file):
+    """Returns the name of the (project) folder that contains "raw_file",
+    skipping over a RAW files folder if there is one.
+    """
+    container_path = os.path.split(raw_file)[0]
+    folder_name = os.path.basename(container_path)
+    if 'RAW' in folder_name.upper():
+        container_path = os.path.split(container_path)[0]
+        folder_name = os.path.basename(container_path)
+    return folder_name
+
+def copy_raw_files(raw_file_list, top_folders, obj_list):
+    """Makes verified copies of "raw_file_list" (files from one project) in
+    <project>/raw_files folders under each of "top_folders". Log lines go to
+    "obj_list". Returns the files that could not be copied everywhere.
+    """
+    # get the folder name that contains the raw files
+    folder_name = project_name(raw_file_list[0])
+
+    # add project folder to destination(s) and optional raw_files subfolder
+    destination_folders = []
+    for folder in top_folders:
+        if RAW_FOLDER:
+            destination_folders.append(os.path.join(folder, folder_name, 'raw_files'))
+        else:
+            destination_folders.append(os.path.join(folder, folder_name))
+
+    # create the destination location folder(s)
+    for destination_folder in destination_folders:
+        if not os.path.exists(destination_folder):
+            os.makedirs(destination_folder)
+
+    # copy files with a number of retries
+    copied_files = [0 for folder in destination_folders]
+    repaired_files = [0 for folder in destination_folders]
+    verified_files = [0 for folder in destination_folders]
+    for obj in obj_list:
+        print('processing: %s on %s' %
+              (os.path.split(raw_file_list[0])[0], time.ctime()), file=obj)
+        print('copies are written with: %s' % copy_backend(), file=obj)
+        print('copies are verified by reading them back with: %s' % verify_mode(), file=obj)
+    skipped_files = 0
+    not_copied = []
+    rewritten_chunks = 0
+    failed_chunks = 0
+    if RESUME:
+        journals = [CopyJournal(folder) for folder in destination_folders]
+    else:
+        journals = [None for folder in destination_folders]
+    plan = []   # (source, destination indexes, messages) for each selected file
+    jobs = []
+    for source in raw_file_list:
+        raw_basename = os.path.split(source)[1]
+        needed = []
+        existing = []
+        messages = []
+        resume_lists = []
+        for i, journal in enumerate(journals):
+            destination = os.path.join(destination_folders[i], raw_basename)
+            resume = []
+            if journal:
+                # skip files finished by an earlier (interrupted) run, resume partial ones
+                if journal.finished(raw_basename, source, destination):
+                    messages.append('...ALREADY COPIED: %s%s' %
+                                    (raw_basename, label(i, destination_folders)))
+                    continue
+                resume = journal.resume_chunks(raw_basename, source, destination)
+            if SYNC and not resume and os.path.exists(destination):
+                existing.append(destination)    # check the copy that is there in place
+            else:
+                resume_lists.append(resume)
+            needed.append(i)
+        plan.append((source, needed, messages))
+        if not needed:
+            skipped_files += 1
+            continue
+
+        # the source is read once for all destinations that need a copy, so a
+        # resume can only start after the chunks that are on all of them
+        destinations = [os.path.join(destination_folders[i], raw_basename) for i in needed]
+        resume_chunks = min(resume_lists, key=len) if resume_lists else []
+        on_chunks = None
+        if RESUME:
+            on_chunks = [journals[i].start(raw_basename, source, resume_chunks)
+                         for (i, destination) in zip(needed, destinations)
+                         if destination not in existing]
+        jobs.append((source, destinations, resume_chunks, on_chunks, existing))
+
+    # several files are copied at once; results come back in file list order
+    scheduler = CopyScheduler(COPY_WORKERS, READ_STREAMS, WRITE_STREAMS, DEVICE_STREAMS)
+    results = scheduler.run(jobs, copy_file)
+    try:
+        for (source, needed, messages) in plan:
+            raw_basename = os.path.split(source)[1]
+            for obj in obj_list:
+                for message in messages:
+                    print(message, file=obj)
+            if not needed:
+                continue
+
+            # source is hashed while copying; only the copies are read back to check them
+            # and any chunks that do not match are rewritten (up to RETRY times each)
+            ((source, destinations, resume_chunks, on_chunks, existing), copy_results, error) = next(results)
+            log_speed_changes(obj_list)
+            if error:
+                # unreadable source, failed write, etc.; the other files carry on
+                for i in needed:
+                    for obj in obj_list:
+                        print('...WARNING: could not copy: %s%s (%s)' %
+                              (raw_basename, label(i, destination_folders), error), file=obj)
+                not_copied.append(source)
+                continue
+            if resume_chunks:
+                for obj in obj_list:
+                    print('...RESUMED COPY: %s after %s chunks (%s bytes)' %
+                          (raw_basename, len(resume_chunks), len(resume_chunks) * COPY_CHUNK), file=obj)
+            for i, destination, (ok, digest, repairs) in zip(needed, destinations, copy_results):
+                tag = label(i, destination_folders)
+                for (index, tries, chunk_ok) in repairs:
+                    start = index * COPY_CHUNK
+                    end = min(start + COPY_CHUNK, os.path.getsize(source))
+                    for obj in obj_list:
+                        if chunk_ok:
+                            print('...REWROTE CHUNK %s (bytes %s-%s) of %s: %s tries%s' %
+                                  (index, start, end, raw_basename, tries, tag), file=obj)
+                        else:
+                            print('...WARNING: CHUNK %s (bytes %s-%s) of %s still bad after %s tries%s' %
+                                  (index, start, end, raw_basename, tries, tag), file=obj)
+                    if chunk_ok:
+                        rewritten_chunks += 1
+                    else:
+                        failed_chunks += 1
+                if ok and destination in existing:
+                    for obj in obj_list:
+                        if repairs:
+                            print('...REPAIRED EXISTING COPY: %s%s' % (raw_basename, tag), file=obj)
+                        else:
+                            print('...VERIFIED EXISTING COPY: %s%s' % (raw_basename, tag), file=obj)
+                    if repairs:
+                        repaired_files[i] += 1
+                    else:
+                        verified_files[i] += 1
+                elif ok:
+                    for obj in obj_list:
+                        print('...COPY OK: %s%s' % (raw_basename, tag), file=obj)
+                    copied_files[i] += 1
+                if ok:
+                    if journals[i]:
+                        journals[i].finish(raw_basename, source, digest, destination)
+                else:
+                    for obj in obj_list:
+                        print('...WARNING: could not copy: %s%s' % (raw_basename, tag), file=obj)
+                    if source not in not_copied:
+                        not_copied.append(source)
+    finally:
+        # wait for any copies still running before the journals are closed
+        results.close()
+        for journal in journals:
+            if journal:
+                journal.close()
+
+    # print some summaries
+    for obj in obj_list:
+        print('\n%s files read from: %s' % (len(raw_file_list), folder_name), file=obj)
+        for i, destination_folder in enumerate(destination_folders):
+            print('%s files copied to: %s' % (copied_files[i], destination_folder), file=obj)
+            if repaired_files[i] or verified_files[i]:
+                print('...%s existing copies repaired, %s existing copies verified' %
+                      (repaired_files[i], verified_files[i]), file=obj)
+        if skipped_files:
+            print('%s files were already copied (skipped)' % skipped_files, file=obj)
+        if rewritten_chunks or failed_chunks:
+            print('%s chunks rewritten, %s chunks could not be fixed' %
+                  (rewritten_chunks, failed_chunks), file=obj)
+        print(time.ctime(), file=obj)
+    return not_copied
+
+def watch_folders(obj_list, log_obj):
+    """Copies RAW files from WATCH_FOLDERS to WATCH_DESTINATION as acquisitions finish.
+    Runs until stopped (Ctrl-C). Files that could not be copied (including when
+    a destination drive is missing or a file is locked) are tried again on
+    the next poll. Files that are already there when it starts are only
+    copied if WATCH_EXISTING is True.
+    """
+    watcher = StableFileWatcher(WATCH_FOLDERS, WATCH_EXTENSIONS, STABLE_SECONDS, WATCH_DEPTH)
+    if not WATCH_EXISTING:
+        watcher.skip_existing()
+    for obj in obj_list:
+        print('watching: %s on %s' % (', '.join(WATCH_FOLDERS), time.ctime()), file=obj)
+        print('copying finished files to: %s' % WATCH_DESTINATION, file=obj)
+        if not WATCH_EXISTING:
+            print('files already in the watch folders are not copied', file=obj)
+    log_obj.flush()
+    try:
+        while True:
+            # group finished files by project so each lands in its own folder
+            projects = {}
+            for raw_file in watcher.poll():
+                projects.setdefault(os.path.dirname(raw_file), []).append(raw_file)
+            for folder in sorted(projects):
+                try:
+                    not_copied = copy_raw_files(projects[folder],
+                                                [WATCH_DESTINATION] + EXTRA_DESTINATIONS, obj_list)
+                except OSError as e:
+                    # destination drive missing or unplugged, file locked, etc.
+                    for obj in obj_list:
+                        print('...WARNING: could not copy files from %s on %s (will try again): %s' %
+                              (folder, time.ctime(), e), file=obj)
+                    not_copied = projects[folder]
+                for raw_file in not_copied:
+                    watcher.forget(raw_file)
+                log_obj.flush()
+
+            # speed changes are picked up (and logged) while idle too
+            THROTTLE.refresh()
+            log_speed_changes(obj_list)
+            log_obj.flush()
+            time.sleep(POLL_SECONDS)
+    except KeyboardInterrupt:
+        for obj in obj_list:
+            print('\nstopped watching on %s' % time.ctime(), file=obj)
+
 def get_drives():
     """From "http://stackoverflow.com/
     questions/827371/is-there-a-way-to-list-all-the-available-drive-letters-in-python"
     Gets drive letters without using win32api module (not part of standard dist.).
+    Returns an empty list on other systems.
     """
     drives = []
+    if sys.platform != 'win32':
+        return drives
+    from ctypes import windll   # Windows only
     bitmask = windll.kernel32.GetLogicalDrives()
     for letter in string.ascii_uppercase:
         if bitmask & 1:
@@ -134,6 +434,23 @@ print('====================================================')
 log_obj = open('copy_raw_files_log.txt', 'a')
 obj_list = [None, log_obj]
 
+# copy speed limit and I/O priority (the speed can be changed with SPEED_FILE while running)
+THROTTLE.set_rate(MAX_MB_PER_SECOND)
+THROTTLE.control_file = SPEED_FILE
+priority = set_io_priority(IO_PRIORITY)
+for obj in obj_list:
+    if MAX_MB_PER_SECOND:
+        print('speed limit: %s MB/s (change it in %s)' % (MAX_MB_PER_SECOND, SPEED_FILE), file=obj)
+    else:
+        print('speed limit: none (set one in %s)' % SPEED_FILE, file=obj)
+    print('I/O priority: %s' % priority, file=obj)
+
+# headless mode: no dialogs, runs until stopped
+if WATCH:
+    watch_folders(obj_list, log_obj)
+    log_obj.close()
+    sys.exit()
+
 # set up things to get the list of RAW files
 default_loc = r'E:\PSR_data'
 extensions = [('All File(s)', '*.*'),
@@ -149,13 +466,6 @@ raw_file_list = get_files(default_loc, extensions, title_message)
 if not raw_file_list:
     sys.exit() # cancel button repsonse
 
-# get the folder name that contains the raw files
-container_path = os.path.split(raw_file_list[0])[0]
-folder_name = os.path.basename(container_path)
-if 'RAW' in folder_name.upper():
-    container_path = os.path.split(container_path)[0]
-    folder_name = os.path.basename(container_path)
-
 # try to get list of all drives so browsing starts somewhere sensible
 external_drives = get_drives()
 
@@ -179,47 +489,6 @@ destination_folder = get_folder(default_loc, title_message)
 if not destination_folder:
     sys.exit()
 
-# add project folder to destination and optional raw_files subfolder
-if RAW_FOLDER:
-    destination_folder = os.path.join(destination_folder, folder_name, 'raw_files')
-else:
-    destination_folder = os.path.join(destination_folder, folder_name)
-
-# create the destination location folder
-if not os.path.exists(destination_folder):
-    os.makedirs(destination_folder)
-
-# copy files with a number of retries
-copied_files = 0
-for obj in obj_list:
-    print('processing: %s on %s' %
-          (os.path.split(raw_file_list[0])[0], time.ctime()), file=obj)
-for source in raw_file_list:
-    raw_basename = os.path.split(source)[1]
-    destination = os.path.join(destination_folder, raw_basename)
-    try_count = 0
-    redo = True
-    while redo:
-        shutil.copy2(source, destination)
-        try_count += 1
-        if filecmp.cmp(source, destination, shallow=False):
-            for obj in obj_list:
-                print('...COPY OK:', raw_basename, file=obj)
-            copied_files += 1
-            redo = False
-        elif try_count > RETRY:
-            for obj in obj_list:
-                print('...WARNING: could not copy:', raw_basename, file=obj)
-            redo = False
-        else:
-            for obj in obj_list:
-                print('...RETRYING COPY:', raw_basename, file=obj)
-
-# print some summaries
-for obj in obj_list:
-    print('\n%s files read from: %s' % (len(raw_file_list), folder_name), file=obj)
-    print('%s files copied to: %s' % (copied_files, destination_folder), file=obj)
-    print(time.ctime(), file=obj)
-
+copy_raw_files(raw_file_list, [destination_folder] + EXTRA_DESTINATIONS, obj_list)
 log_obj.close()
 # end
@@ -0,0 +1,937 @@
+"""copy_tools.py
+Shared file copy helpers for copy_raw_files.py (and other scripts in this
+folder). Copies are checked against a digest of the source data that is
+computed while the data is being copied, so the source only has to be
+read once. There is no GUI code in here. Keep this file (and
+compare_tools.py) in the same folder as the scripts that import it.
+
+Where the filesystem supports it (Linux btrfs, XFS, etc.), a copy is made as
+a reflink that shares the source's data blocks, so no data is written. Other
+copies are written from the Python buffers the source is hashed from; a
+kernel copy (copy_file_range or sendfile) would only read the source a second
+time, and the bytes hashed would not be the bytes written.
+
+Copies are flushed to the device and dropped from the OS page cache before
+they are read back, so verification reads what landed on the drive and not
+what is still sitting in memory. Where the OS has them (Linux), copies also
+use streaming hints (posix_fadvise) so gigabytes of RAW data do not push
+everything else out of the page cache. On Windows the copy is flushed
+(fsync) and read back with FILE_FLAG_NO_BUFFERING, which skips the file cache.
+"""
+import os
+import io
+import sys
+import time
+import mmap
+import shutil
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import ctypes
+import platform
+try:
+    import fcntl     # not on Windows (no reflinks there)
+except ImportError:
+    fcntl = None
+
+from compare_tools import new_hash
+
+# read/write size for copies and verification reads
+COPY_BUFSIZE = 8 * 1024 * 1024
+# copies are checked (and bad parts rewritten) in pieces of this size
+COPY_CHUNK = 16 * 1024 * 1024
+# files at least this big are "large": one at a time per device (smaller files fill in)
+LARGE_FILE = 256 * 1024 * 1024
+# name of the copy journal kept in destination folders
+JOURNAL_NAME = 'copy_journal.txt'
+# use streaming hints and write back copies as they go (keeps the page cache small)
+STREAM_HINTS = True
+# how much copied data to write back to the device at a time
+WRITEBACK_BYTES = 64 * 1024 * 1024
+# flush copies and read them back from the device (not the page cache)
+UNCACHED_VERIFY = True
+# read back with O_DIRECT (Linux) or FILE_FLAG_NO_BUFFERING (Windows) where the
+# OS and filesystem support it
+DIRECT_IO = True
+# 'auto': copies are reflinks (share the source's data blocks) where the filesystem
+# supports it; 'python': always written from Python buffers
+COPY_BACKEND = 'auto'
+# Linux ioctl that makes a file share another file's data blocks (btrfs, XFS, etc.)
+FICLONE = 0x40049409
+# Linux ioprio_set system call numbers (there is no Python wrapper for it)
+IOPRIO_SET = {'x86_64': 251, 'aarch64': 30, 'i686': 289, 'i386': 289}
+# how often (seconds) the speed limit control file is checked for changes
+CONTROL_CHECK = 2.0
+
+def advise(fd, advice, offset=0, length=0):
+    """Passes an access hint ('SEQUENTIAL', 'DONTNEED', etc.) to the OS.
+    Does nothing where posix_fadvise is not available.
+    """
+    if hasattr(os, 'posix_fadvise'):
+        try:
+            os.posix_fadvise(fd, offset, length, getattr(os, 'POSIX_FADV_' + advice))
+        except OSError:
+            pass
+
+def flush_file(file_obj, drop=True):
+    """Writes buffered data to the device and (optionally) drops it from the page cache.
+    """
+    file_obj.flush()
+    os.fsync(file_obj.fileno())
+    if drop:
+        advise(file_obj.fileno(), 'DONTNEED')
+
+def verify_mode():
+    """Describes how verification reads are done (for the log files).
+    """
+    if not UNCACHED_VERIFY:
+        return 'page cache'
+    if DIRECT_IO and hasattr(os, 'O_DIRECT'):
+        return 'direct I/O (falls back to flush and drop cache)'
+    if DIRECT_IO and sys.platform == 'win32':
+        return 'unbuffered reads (FILE_FLAG_NO_BUFFERING, falls back to flush only)'
+    if hasattr(os, 'posix_fadvise'):
+        return 'flush and drop cache'
+    return 'flush only'
+
+def copy_backend():
+    """Describes how copies are written (for the log files).
+    """
+    if COPY_BACKEND == 'auto' and fcntl is not None and sys.platform.startswith('linux'):
+        return 'reflink where the filesystem supports it, otherwise Python buffers'
+    return 'Python buffers'
+
+def reflink(source_fd, destination_fd):
+    """Makes the destination share the source's data blocks (no data is copied).
+    Returns False if the OS or filesystems do not support it.
+    """
+    if COPY_BACKEND != 'auto' or fcntl is None or not sys.platform.startswith('linux'):
+        return False
+    try:
+        fcntl.ioctl(destination_fd, FICLONE, source_fd)
+        return True
+    except OSError:
+        return False
+
+def write_block(destination_obj, block):
+    """Writes all of "block" to an unbuffered file (a raw write can write
+    less than it was given).
+    """
+    with memoryview(block) as view:
+        done = 0
+        while done < len(block):
+            done += destination_obj.write(view[done:])
+
+class RateLimiter:
+    """Token bucket that limits copy and verification reads to a number of MB/s
+    (0 means no limit). It is shared by all copy threads. If "control_file"
+    is set, the limit is read from it (a number of MB/s) whenever the file
+    changes, so the speed can be changed while a copy is running.
+    """
+    def __init__(self, mb_per_second=0, control_file=None):
+        self.lock = threading.Lock()
+        self.control_file = control_file
+        self.control_stamp = None
+        self.checked = 0
+        self.changes = []   # (time, MB/s) for the log files
+        self.set_rate(mb_per_second)
+
+    def set_rate(self, mb_per_second):
+        """Sets the limit (MB/s, 0 for no limit).
+        """
+        self.mb_per_second = mb_per_second
+        self.rate = mb_per_second * 1024 * 1024
+        self.tokens = self.rate     # up to one second of burst
+        self.updated = time.monotonic()
+
+    def check_control_file(self):
+        """Picks up a new limit from the control file if it has changed.
+        """
+        self.checked = time.monotonic()
+        try:
+            stamp = os.stat(self.control_file).st_mtime_ns
+            if stamp == self.control_stamp:
+                return
+            self.control_stamp = stamp
+            with open(self.control_file) as control_obj:
+                mb_per_second = float(control_obj.read().split()[0])
+        except (OSError, ValueError, IndexError):
+            return      # missing or half-written file, keep the current limit
+        if mb_per_second != self.mb_per_second:
+            self.set_rate(mb_per_second)
+            self.changes.append((time.ctime(), mb_per_second))
+
+    def refresh(self):
+        """Checks the control file now (e.g. while no copies are running).
+        """
+        with self.lock:
+            if self.control_file:
+                self.check_control_file()
+
+    def take(self, count):
+        """Waits until "count" bytes can be read within the limit.
+        """
+        with self.lock:
+            now = time.monotonic()
+            if self.control_file and now - self.checked >= CONTROL_CHECK:
+                self.check_control_file()
+            if not self.rate:
+                return
+            self.tokens = min(self.rate, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= count
+            wait = -self.tokens / self.rate
+        if wait > 0:
+            time.sleep(wait)
+
+    def pop_changes(self):
+        """Returns (and clears) the limit changes made since the last call.
+        """
+        with self.lock:
+            (changes, self.changes) = (self.changes, [])
+        return changes
+
+# shared by everything in this module; set it up with THROTTLE.set_rate, etc.
+THROTTLE = RateLimiter()
+
+def set_io_priority(level):
+    """Sets the I/O priority ('normal', 'low' or 'idle') for this process and
+    any threads it starts afterwards. Returns a description for the log files.
+    """
+    if level == 'normal':
+        return 'normal'
+    if sys.platform == 'win32':
+        # background mode lowers both CPU and I/O priority for the whole process
+        PROCESS_MODE_BACKGROUND_BEGIN = 0x00100000
+        kernel32 = ctypes.windll.kernel32
+        if kernel32.SetPriorityClass(kernel32.GetCurrentProcess(), PROCESS_MODE_BACKGROUND_BEGIN):
+            return 'background'
+        return 'normal (could not set background mode)'
+    if sys.platform.startswith('linux') and platform.machine() in IOPRIO_SET:
+        # class 3 is "idle" (only uses the disk when nothing else does), 2 is "best effort"
+        (io_class, io_data) = (3, 0) if level == 'idle' else (2, 7)
+        try:
+            libc = ctypes.CDLL(None, use_errno=True)
+            if libc.syscall(IOPRIO_SET[platform.machine()], 1, 0, (io_class << 13) | io_data) == 0:
+                return 'idle' if level == 'idle' else 'low (best effort, level 7)'
+        except (OSError, AttributeError):
+            pass
+    # lower CPU priority also lowers I/O priority with most Linux disk schedulers
+    try:
+        os.nice(19 if level == 'idle' else 10)
+        return 'low (nice)'
+    except (AttributeError, OSError):
+        return 'normal (could not be changed)'
+
+def copy_with_digest(source, destinations, bufsize=COPY_BUFSIZE, chunk_size=COPY_CHUNK,
+                     resume_chunks=(), on_chunks=None):
+    """Copies "source" to each path in "destinations" (contents and times, like
+    shutil.copy2), reading the source only once. Returns the digest of the
+    data that was read from the source, a list of digests of each
+    "chunk_size" piece of it, and the number of bytes copied.
+
+    If "resume_chunks" (digests of chunks that are already on all of the
+    destinations) is given, copying starts after them and the whole file
+    digest is None. If "on_chunks" (one function per destination) is given,
+    each chunk is written to the devices before on_chunk(index, digest) is
+    called.
+    """
+    chunks = list(resume_chunks)
+    if not all(os.path.exists(destination) for destination in destinations):
+        chunks = []
+    offset = len(chunks) * chunk_size
+    source_hash = None if chunks else new_hash()
+    destination_objs = []
+    shared = []     # True for copies that are reflinks (nothing to write)
+    try:
+        for destination in destinations:
+            # unbuffered: blocks are large, so Python buffering would only copy them again
+            if chunks:
+                destination_obj = open(destination, 'r+b', buffering=0)
+                destination_obj.truncate(offset)
+                destination_obj.seek(offset)
+            else:
+                destination_obj = open(destination, 'wb', buffering=0)
+            destination_objs.append(destination_obj)
+        with open(source, 'rb') as source_obj:
+            source_fd = source_obj.fileno()
+            for destination_obj in destination_objs:
+                shared.append(not chunks and reflink(source_fd, destination_obj.fileno()))
+            if STREAM_HINTS:
+                advise(source_fd, 'SEQUENTIAL')
+            source_obj.seek(offset)
+            written = 0
+            chunk_hash = new_hash()
+            while True:
+                block = source_obj.read(min(bufsize, chunk_size - offset % chunk_size))
+                if not block:
+                    break
+                THROTTLE.take(len(block))
+                if source_hash:
+                    source_hash.update(block)
+                chunk_hash.update(block)
+                for destination_obj, is_shared in zip(destination_objs, shared):
+                    if not is_shared:
+                        write_block(destination_obj, block)
+                offset += len(block)
+                if offset % chunk_size == 0:
+                    chunks.append(chunk_hash.hexdigest())
+                    chunk_hash = new_hash()
+                    if on_chunks:
+                        for destination_obj, on_chunk in zip(destination_objs, on_chunks):
+                            flush_file(destination_obj, drop=STREAM_HINTS)
+                            on_chunk(len(chunks) - 1, chunks[-1])
+                        written = 0
+                if STREAM_HINTS:
+                    advise(source_fd, 'DONTNEED', offset - len(block), len(block))
+                    written += len(block)
+                    if written >= WRITEBACK_BYTES:
+                        for destination_obj in destination_objs:
+                            flush_file(destination_obj)
+                        written = 0
+            if offset % chunk_size:
+                chunks.append(chunk_hash.hexdigest())
+        if UNCACHED_VERIFY or STREAM_HINTS or on_chunks:
+            for destination_obj in destination_objs:
+                flush_file(destination_obj, drop=UNCACHED_VERIFY or STREAM_HINTS)
+    finally:
+        for destination_obj in destination_objs:
+            destination_obj.close()
+    for destination in destinations:
+        shutil.copystat(source, destination)
+    return (source_hash.hexdigest() if source_hash else None), chunks, offset
+
+def open_direct(file_path):
+    """Opens a file for reads that bypass the page cache (O_DIRECT on Linux,
+    FILE_FLAG_NO_BUFFERING on Windows). Returns a file descriptor. Raises
+    OSError if the OS or filesystem cannot do it.
+    """
+    if sys.platform != 'win32':
+        if not hasattr(os, 'O_DIRECT'):
+            raise OSError('no O_DIRECT on this system')
+        return os.open(file_path, os.O_RDONLY | os.O_DIRECT)
+    import msvcrt
+    from ctypes import wintypes
+    GENERIC_READ = 0x80000000
+    FILE_SHARE_ALL = 0x7    # read, write and delete
+    OPEN_EXISTING = 3
+    FILE_FLAG_NO_BUFFERING = 0x20000000
+    FILE_FLAG_SEQUENTIAL_SCAN = 0x08000000
+    kernel32 = ctypes.WinDLL('kernel32', use_last_error=True)
+    kernel32.CreateFileW.restype = wintypes.HANDLE
+    kernel32.CreateFileW.argtypes = [wintypes.LPCWSTR, wintypes.DWORD, wintypes.DWORD, wintypes.LPVOID,
+                                     wintypes.DWORD, wintypes.DWORD, wintypes.HANDLE]
+    handle = kernel32.CreateFileW(os.path.abspath(file_path), GENERIC_READ, FILE_SHARE_ALL, None,
+                                  OPEN_EXISTING, FILE_FLAG_NO_BUFFERING | FILE_FLAG_SEQUENTIAL_SCAN, None)
+    if handle is None or handle == wintypes.HANDLE(-1).value:
+        raise ctypes.WinError(ctypes.get_last_error())
+    try:
+        return msvcrt.open_osfhandle(handle, os.O_RDONLY)
+    except OSError:
+        kernel32.CloseHandle(wintypes.HANDLE(handle))
+        raise
+
+def read_at(fd, view, offset):
+    """Reads into "view" (a writable memoryview) from "offset" of an open file,
+    without an extra copy of the data. Returns the number of bytes read.
+    """
+    if hasattr(os, 'preadv'):
+        return os.preadv(fd, [view], offset)
+    os.lseek(fd, offset, os.SEEK_SET)   # no preadv on Windows
+    with io.FileIO(fd, 'rb', closefd=False) as raw_obj:
+        return raw_obj.readinto(view)
+
+class BlockReader:
+    """Reads blocks of a file at given offsets. If "uncached", the data comes
+    from the device rather than the page cache (see open_direct) where the OS
+    and filesystem allow it; otherwise the cached pages are dropped first
+    (only possible on Linux).
+    """
+    def __init__(self, file_path, uncached=False, bufsize=COPY_BUFSIZE):
+        self.file_path = file_path
+        self.bufsize = bufsize
+        self.file_obj = None
+        self.buffer = None
+        if uncached and DIRECT_IO:
+            try:
+                self.fd = open_direct(file_path)
+                # page aligned, as direct and unbuffered reads need
+                self.buffer = mmap.mmap(-1, -(-bufsize // mmap.PAGESIZE) * mmap.PAGESIZE)
+            except OSError:
+                self.buffer = None
+        if self.buffer is None:
+            self.open_buffered(uncached)
+
+    def open_buffered(self, uncached):
+        """Opens the file normally (used when direct reads are not possible).
+        """
+        self.file_obj = open(self.file_path, 'rb')
+        self.fd = self.file_obj.fileno()
+        if uncached:
+            advise(self.fd, 'DONTNEED')
+        if STREAM_HINTS:
+            advise(self.fd, 'SEQUENTIAL')
+
+    def read(self, offset, size):
+        """Returns up to "size" (no more than bufsize) bytes starting at "offset".
+        Offsets should be multiples of the page size.
+        """
+        if self.buffer is not None:
+            THROTTLE.take(size)
+            # direct reads are whole pages (the one at the end of the file comes back short)
+            pages = -(-size // mmap.PAGESIZE) * mmap.PAGESIZE
+            try:
+                with memoryview(self.buffer) as view:
+                    count = read_at(self.fd, view[:pages], offset)
+                    return view[:min(count, size)].tobytes()
+            except OSError:
+                pass
+            # filesystem does not do direct reads (or the offset is not aligned), read
+            # normally instead (outside the except block, so the buffer is free to close)
+            os.close(self.fd)
+            self.buffer.close()
+            self.buffer = None
+            self.open_buffered(True)
+        else:
+            THROTTLE.take(size)
+        self.file_obj.seek(offset)
+        block = self.file_obj.read(size)
+        if STREAM_HINTS:
+            advise(self.fd, 'DONTNEED', offset, len(block))
+        return block
+
+    def close(self):
+        if self.buffer is not None:
+            os.close(self.fd)
+            self.buffer.close()
+        else:
+            self.file_obj.close()
+
+def chunk_digests(file_path, chunk_size=COPY_CHUNK, indexes=None, uncached=False,
+                  bufsize=COPY_BUFSIZE):
+    """Reads a file and returns {chunk index: digest} for the "chunk_size"
+    pieces listed in "indexes" (all of them if None), plus the whole file digest
+    (only when all chunks are read).
+    """
+    file_size = os.path.getsize(file_path)
+    if indexes is None:
+        indexes = range((file_size + chunk_size - 1) // chunk_size)
+        file_hash = new_hash()
+    else:
+        file_hash = None
+    digests = {}
+    reader = BlockReader(file_path, uncached, bufsize)
+    try:
+        for index in indexes:
+            chunk_hash = new_hash()
+            offset = index * chunk_size
+            end = min(offset + chunk_size, file_size)
+            while offset < end:
+                block = reader.read(offset, min(bufsize, end - offset))
+                if not block:
+                    break
+                chunk_hash.update(block)
+                if file_hash:
+                    file_hash.update(block)
+                offset += len(block)
+            digests[index] = chunk_hash.hexdigest()
+    finally:
+        reader.close()
+    return digests, (file_hash.hexdigest() if file_hash else None)
+
+def file_digest(file_path, bufsize=COPY_BUFSIZE, uncached=False):
+    """Reads a file and returns its digest. If "uncached", the data is read
+    from the device rather than from the page cache (as far as the OS allows).
+    """
+    file_hash = new_hash()
+    reader = BlockReader(file_path, uncached, bufsize)
+    try:
+        offset = 0
+        while True:
+            block = reader.read(offset, bufsize)
+            if not block:
+                break
+            file_hash.update(block)
+            offset += len(block)
+    finally:
+        reader.close()
+    return file_hash.hexdigest()
+
+def rewrite_chunk(source, destination, index, expected, chunk_size=COPY_CHUNK,
+                  bufsize=COPY_BUFSIZE, size=None):
+    """Copies one chunk of "source" over the same chunk of "destination"
+    (no further than "size" bytes into the file, if given). The source chunk
+    is checked against its "expected" digest before it is written. Returns
+    False if the source read did not match.
+    """
+    offset = index * chunk_size
+    length = chunk_size if size is None else max(0, min(chunk_size, size - offset))
+    with open(source, 'rb') as source_obj:
+        source_obj.seek(offset)
+        THROTTLE.take(length)
+        data = source_obj.read(length)
+        if STREAM_HINTS:
+            advise(source_obj.fileno(), 'DONTNEED', offset, len(data))
+    chunk_hash = new_hash()
+    chunk_hash.update(data)
+    if chunk_hash.hexdigest() != expected:
+        return False
+    with open(destination, 'r+b') as destination_obj:
+        destination_obj.seek(offset)
+        for start in range(0, len(data), bufsize):
+            destination_obj.write(data[start:start + bufsize])
+        flush_file(destination_obj, drop=UNCACHED_VERIFY or STREAM_HINTS)
+    return True
+
+def check_copy(source, destination, source_chunks, size, retry=3, chunk_size=COPY_CHUNK):
+    """Reads "destination" back and compares its chunk digests to "source_chunks"
+    (the digests of the "size" bytes that were copied). Chunks that do not
+    match are rewritten in place from "source" and checked again, up to
+    "retry" times each.
+
+    Returns (ok, copy digest, repairs), where repairs is a list of
+    (chunk index, tries, ok) for each chunk that had to be rewritten.
+    """
+    if os.path.getsize(destination) != size:
+        os.truncate(destination, size)   # wrong length shows up as bad chunks
+    (copy_chunks, copy_digest) = chunk_digests(destination, chunk_size, uncached=UNCACHED_VERIFY)
+    copy_list = [copy_chunks[index] for index in sorted(copy_chunks)]
+    if copy_list == source_chunks:
+        return True, copy_digest, []
+
+    # rewrite the chunks that do not match
+    repairs = []
+    for index, expected in enumerate(source_chunks):
+        if copy_chunks.get(index) == expected:
+            continue
+        tries = 0
+        chunk_ok = False
+        while not chunk_ok and tries < retry:
+            tries += 1
+            if rewrite_chunk(source, destination, index, expected, chunk_size, size=size):
+                (digests, _) = chunk_digests(destination, chunk_size, [index],
+                                             uncached=UNCACHED_VERIFY)
+                chunk_ok = digests[index] == expected
+        repairs.append((index, tries, chunk_ok))
+    shutil.copystat(source, destination)
+    # a chunk list that differs only in length has nothing to repair, so it is not ok
+    ok = (bool(repairs) and len(copy_list) == len(source_chunks) and
+          all(chunk_ok for (index, tries, chunk_ok) in repairs))
+    return ok, None, repairs
+
+def check_copies(source, destinations, source_chunks, size, retry=3, chunk_size=COPY_CHUNK):
+    """Runs check_copy for each of "destinations" (one thread per destination).
+    """
+    if len(destinations) == 1:
+        return [check_copy(source, destinations[0], source_chunks, size, retry, chunk_size)]
+    with ThreadPoolExecutor(len(destinations)) as executor:
+        return list(executor.map(lambda destination: check_copy(source, destination,
+                                                                source_chunks, size, retry,
+                                                                chunk_size),
+                                 destinations))
+
+def sync_copy(source, destinations, retry=3, chunk_size=COPY_CHUNK):
+    """Checks existing copies of "source" in place: the source is read once for
+    its chunk digests, then each copy is read back and only the chunks that do
+    not match are rewritten (see check_copy). A copy of the wrong length is
+    cut or padded to the right length first.
+    Returns a list of (ok, digest, repairs), one per destination.
+    """
+    return fan_out_copy(source, destinations, retry, chunk_size, existing=destinations)
+
+def fan_out_copy(source, destinations, retry=3, chunk_size=COPY_CHUNK,
+                 resume_chunks=(), on_chunks=None, existing=()):
+    """Copies "source" to all of "destinations" (reading it once) and checks
+    each copy on its own (at the same time, one thread per destination).
+
+    The source is hashed (whole file and per chunk) while it is copied, then
+    only the destinations are read back and their chunk digests compared to
+    the source's. Chunks that do not match are rewritten in place and checked
+    again, up to "retry" times each, so a bad copy costs a few chunks rather
+    than the whole file. "resume_chunks" and "on_chunks" (one per new copy)
+    are passed to copy_with_digest (resumed copies are still read back in
+    full). Destinations listed in "existing" are not copied to; they are
+    checked (and repaired) in place against the same source digests, so the
+    source is still read only once.
+
+    Returns a list of (ok, digest, repairs), one per destination, where
+    repairs is a list of (chunk index, tries, ok) for each chunk that had
+    to be rewritten.
+    """
+    new = [destination for destination in destinations if destination not in existing]
+    if new:
+        (source_digest, source_chunks, size) = copy_with_digest(source, new,
+                                                                chunk_size=chunk_size,
+                                                                resume_chunks=resume_chunks,
+                                                                on_chunks=on_chunks)
+    else:
+        size = os.path.getsize(source)  # chunk_digests reads this much (less only if it shrinks)
+        (digests, source_digest) = chunk_digests(source, chunk_size)
+        source_chunks = [digests[index] for index in sorted(digests)]
+    checks = check_copies(source, destinations, source_chunks, size, retry, chunk_size)
+    results = []
+    for destination, (ok, copy_digest, repairs) in zip(destinations, checks):
+        digest = source_digest or copy_digest
+        if ok and digest is None:
+            # resumed copy that needed repairs, so no whole file digest yet
+            digest = source_digest = file_digest(destination, uncached=UNCACHED_VERIFY)
+        results.append((ok, digest, repairs))
+    return results
+
+def verified_copy(source, destination, retry=3, chunk_size=COPY_CHUNK,
+                  resume_chunks=(), on_chunk=None):
+    """Copies "source" to "destination" and checks the copy (see fan_out_copy).
+    Returns (ok, digest, repairs).
+    """
+    return fan_out_copy(source, [destination], retry, chunk_size, resume_chunks,
+                        [on_chunk] if on_chunk else None)[0]
+
+def copy_tree(source_folder, destination_folders, retry=3):
+    """Copies a folder tree (like shutil.copytree) to each of "destination_folders",
+    reading each source file only once. Every copy is checked (see fan_out_copy).
+    Returns one list per destination of the files (relative paths) whose copies
+    could not be made to match.
+    """
+    failed = [[] for destination_folder in destination_folders]
+    def walk_error(error):
+        raise error
+    for path, dirs, files in os.walk(source_folder, onerror=walk_error):
+        relative = os.path.relpath(path, source_folder)
+        targets = [os.path.normpath(os.path.join(folder, relative)) for folder in destination_folders]
+        for target in targets:
+            os.makedirs(target, exist_ok=True)
+        for name in files:
+            results = fan_out_copy(os.path.join(path, name),
+                                   [os.path.join(target, name) for target in targets], retry)
+            for i, (ok, digest, repairs) in enumerate(results):
+                if not ok:
+                    failed[i].append(os.path.join(relative, name))
+
+    # folder times last (copying files into them changes them)
+    for path, dirs, files in os.walk(source_folder):
+        relative = os.path.relpath(path, source_folder)
+        for folder in destination_folders:
+            shutil.copystat(path, os.path.normpath(os.path.join(folder, relative)))
+    return failed
+
+def source_key(file_path):
+    """Returns (size, mtime in ns) used to tell if a source file has changed.
+    """
+    file_stat = os.stat(file_path)
+    return file_stat.st_size, file_stat.st_mtime_ns
+
+class CopyJournal:
+    """Tab-delimited journal of the copies made into one destination folder.
+
+    Each chunk of a copy is recorded (with its source digest) once it has been
+    written to the device, and each file once its copy has been verified. If a
+    transfer is interrupted, the next run can skip finished files and pick up
+    partial ones after their last recorded chunk. Lines are:
+        start <name> <size> <mtime> (a new copy of the file was started)
+        chunk <name> <size> <mtime> <index> <digest>
+        done <name> <size> <mtime> <digest> <copy mtime>
+    where size and mtime (ns) are of the source file. The digests make the
+    journal a sidecar of verified copies for sync runs. The journal is
+    compacted each time it is opened.
+    """
+    def __init__(self, folder, name=JOURNAL_NAME):
+        self.path = os.path.join(folder, name)
+        self.done = {}      # file name: (size, mtime, digest, copy mtime)
+        self.partial = {}   # file name: (size, mtime, [chunk digests])
+        if os.path.exists(self.path):
+            self.load()
+            self.compact()
+        self.journal_obj = open(self.path, 'a')
+        self.lock = threading.Lock()     # chunks can be recorded from copy threads
+
+    def load(self):
+        """Reads the journal (a torn last line from an interruption is ignored).
+        """
+        with open(self.path) as journal_obj:
+            for line in journal_obj:
+                items = line.rstrip('\n').split('\t')
+                try:
+                    (kind, name, key) = (items[0], items[1], (int(items[2]), int(items[3])))
+                except (IndexError, ValueError):
+                    continue
+                if kind == 'start':
+                    self.done.pop(name, None)
+                    self.partial[name] = key + ([],)
+                elif kind == 'chunk' and len(items) == 6:
+                    chunks = self.partial.get(name, (None, None, []))
+                    index = int(items[4])
+                    if chunks[:2] == key and index <= len(chunks[2]):
+                        del chunks[2][index:]   # a resumed copy rewrote from here
+                        chunks[2].append(items[5])
+                elif kind == 'done' and len(items) in (5, 6):
+                    self.partial.pop(name, None)
+                    copy_mtime = int(items[5]) if len(items) == 6 else None
+                    self.done[name] = key + (items[4], copy_mtime)
+
+    def compact(self):
+        """Rewrites the journal with just the current state.
+        """
+        temp_path = self.path + '.tmp'
+        with open(temp_path, 'w') as journal_obj:
+            for name, (size, mtime, digest, copy_mtime) in sorted(self.done.items()):
+                if copy_mtime is None:
+                    print('done\t%s\t%s\t%s\t%s' % (name, size, mtime, digest), file=journal_obj)
+                else:
+                    print('done\t%s\t%s\t%s\t%s\t%s' % (name, size, mtime, digest, copy_mtime),
+                          file=journal_obj)
+            for name, (size, mtime, chunks) in sorted(self.partial.items()):
+                print('start\t%s\t%s\t%s' % (name, size, mtime), file=journal_obj)
+                for index, digest in enumerate(chunks):
+                    print('chunk\t%s\t%s\t%s\t%s\t%s' % (name, size, mtime, index, digest),
+                          file=journal_obj)
+            flush_file(journal_obj, drop=False)
+        os.replace(temp_path, self.path)
+
+    def write(self, *items):
+        """Appends one line and makes sure it is on the device.
+        """
+        with self.lock:
+            print('\t'.join([str(x) for x in items]), file=self.journal_obj)
+            flush_file(self.journal_obj, drop=False)
+
+    def finished(self, name, source, destination):
+        """Returns the recorded digest if "source" was already copied to
+        "destination" (and neither has changed size or time since), otherwise None.
+        """
+        entry = self.done.get(name)
+        if not entry or entry[:2] != source_key(source) or not os.path.exists(destination):
+            return None
+        (copy_size, copy_mtime) = source_key(destination)
+        if copy_size != entry[0] or (entry[3] is not None and copy_mtime != entry[3]):
+            return None
+        return entry[2]
+
+    def resume_chunks(self, name, source, destination, chunk_size=COPY_CHUNK):
+        """Returns the digests of the chunks of an interrupted copy of "source"
+        that are already on "destination" (an empty list if there are none).
+        """
+        entry = self.partial.get(name)
+        if not entry or entry[:2] != source_key(source) or not os.path.exists(destination):
+            return []
+        chunks = entry[2][:os.path.getsize(destination) // chunk_size]
+        return chunks
+
+    def start(self, name, source, resume_chunks=()):
+        """Records the start of a copy and returns the on_chunk function for it.
+        """
+        key = source_key(source)
+        if not resume_chunks:
+            self.write('start', name, *key)
+        def on_chunk(index, digest):
+            self.write('chunk', name, key[0], key[1], index, digest)
+        return on_chunk
+
+    def finish(self, name, source, digest, destination):
+        """Records a verified copy (with the copy's time, so later changes to it are noticed).
+        """
+        self.write('done', name, *source_key(source), digest, source_key(destination)[1])
+
+    def close(self):
+        self.journal_obj.close()
+
+def device_of(path):
+    """Returns an id for the device (drive) that "path" (or its folder) is on.
+    """
+    while not os.path.exists(path):
+        parent = os.path.dirname(path)
+        if parent == path:
+            break   # missing drive (os.stat raises OSError)
+        path = parent
+    return os.stat(path).st_dev
+
+def destination_devices(destinations):
+    """Returns the devices for a destination path or a list of them (fan-out copies).
+    """
+    if isinstance(destinations, str):
+        destinations = [destinations]
+    return [device_of(destination) for destination in destinations]
+
+class CopyScheduler:
+    """Runs copy jobs on several threads at once, with a limit on how many
+    files are read from each source device and written to each destination
+    device at the same time ("device_limits" can set the limit for the
+    devices of specific paths, e.g. {'E:\\': 1}).
+
+    Jobs are started largest file first. Large files (LARGE_FILE or bigger)
+    are copied one at a time per device so they stream, and smaller files
+    fill in the other slots. Results come back in the order the jobs were
+    given, so log lines stay in the same order as the file list. A job that
+    fails does not stop the others.
+    """
+    def __init__(self, workers=4, read_limit=2, write_limit=2, device_limits=None,
+                 large_size=LARGE_FILE):
+        self.workers = workers
+        self.read_limit = read_limit
+        self.write_limit = write_limit
+        self.device_limits = {device_of(path): limit
+                              for (path, limit) in (device_limits or {}).items()}
+        self.large_size = large_size
+
+    def run(self, jobs, func):
+        """Calls func(source, destination, *args) for each (source, destination, *args)
+        in "jobs" and yields (job, result, error) in job order. "destination" can
+        be a list of paths for fan-out copies. "error" is the exception the job
+        raised (and result is None) or None if it worked. Jobs that are running
+        are always finished before this returns (waiting ones are dropped if
+        the caller stops early), so no copy is still writing afterwards.
+        """
+        jobs = list(jobs)
+        if not jobs:
+            return
+        results = {}
+        sizes = []
+        devices = []
+        for i, job in enumerate(jobs):
+            try:
+                sizes.append(os.path.getsize(job[0]))
+                devices.append((device_of(job[0]), destination_devices(job[1])))
+            except OSError as error:
+                # source file or a drive is missing; reported in the job's turn
+                results[i] = (None, error)
+                sizes.append(0)
+                devices.append(None)
+        waiting = sorted([i for i in range(len(jobs)) if i not in results], key=lambda i: -sizes[i])
+        busy = {}       # ('read'/'write'/'large', device): running jobs
+        condition = threading.Condition()
+
+        def next_job():
+            """Returns the biggest waiting job whose devices have free slots (or None).
+            """
+            for position, i in enumerate(waiting):
+                (source_dev, destination_devs) = devices[i]
+                slots = [('read', source_dev)] + [('write', dev) for dev in destination_devs]
+                if sizes[i] >= self.large_size:
+                    slots += [('large', dev) for dev in [source_dev] + destination_devs]
+                slots = sorted(set(slots))
+                if all(busy.get(slot, 0) < self.slot_limit(slot) for slot in slots):
+                    del waiting[position]
+                    for slot in slots:
+                        busy[slot] = busy.get(slot, 0) + 1
+                    return i, slots
+            return None
+
+        def worker():
+            while True:
+                with condition:
+                    job = next_job()
+                    while job is None:
+                        if not waiting:
+                            return
+                        condition.wait()
+                        job = next_job()
+                (i, slots) = job
+                try:
+                    result = (func(*jobs[i]), None)
+                except Exception as error:
+                    result = (None, error)
+                with condition:
+                    results[i] = result
+                    for slot in slots:
+                        busy[slot] -= 1
+                    condition.notify_all()
+
+        threads = [threading.Thread(target=worker, daemon=True)
+                   for _ in range(min(self.workers, len(waiting)))]
+        for thread in threads:
+            thread.start()
+        try:
+            for i, job in enumerate(jobs):
+                with condition:
+                    while i not in results:
+                        condition.wait()
+                    (result, error) = results.pop(i)
+                yield job, result, error
+        finally:
+            with condition:
+                del waiting[:]
+                condition.notify_all()
+            for thread in threads:
+                thread.join()
+
+    def slot_limit(self, slot):
+        """Returns how many jobs can use a ('read'/'write'/'large', device) slot at once.
+        """
+        (kind, device) = slot
+        if kind == 'large':
+            return 1
+        return self.device_limits.get(device, self.read_limit if kind == 'read' else self.write_limit)
+
+class StableFileWatcher:
+    """Polls folders for files that have finished being written (for automatic
+    offloading of RAW files as acquisitions finish).
+
+    A file is "stable" once its size and modification time have not changed
+    for "stable_seconds". Each poll is one directory listing per folder (down
+    to "depth" levels) and uses the sizes and times that come with the
+    listing, so it is cheap enough to run next to an acquisition.
+    """
+    def __init__(self, folders, extensions=('.raw',), stable_seconds=60, depth=2):
+        self.folders = folders
+        self.extensions = tuple(ext.lower() for ext in extensions)
+        self.stable_seconds = stable_seconds
+        self.depth = depth
+        self.seen = {}      # path: (size, mtime, time first seen with that size and mtime)
+        self.handed = {}    # path: (size, mtime) when it was returned by poll
+
+    def scan(self, folder, depth):
+        """Yields (path, size, mtime) for matching files in "folder".
+        """
+        try:
+            entries = list(os.scandir(folder))
+        except OSError:
+            return      # folder missing or being changed, try again next poll
+        for entry in entries:
+            if entry.name.startswith('.'):
+                continue
+            try:
+                if entry.is_dir():
+                    if depth > 0:
+                        yield from self.scan(entry.path, depth - 1)
+                elif entry.name.lower().endswith(self.extensions):
+                    entry_stat = entry.stat()
+                    yield entry.path, entry_stat.st_size, entry_stat.st_mtime_ns
+            except OSError:
+                continue
+
+    def poll(self):
+        """Returns the files that have become stable since the last poll.
+        """
+        now = time.monotonic()
+        ready = []
+        present = set()
+        for folder in self.folders:
+            for (path, size, mtime) in self.scan(folder, self.depth):
+                present.add(path)
+                key = (size, mtime)
+                previous = self.seen.get(path)
+                if previous is None or previous[:2] != key:
+                    self.seen[path] = key + (now,)
+                elif (size and now - previous[2] >= self.stable_seconds
+                      and self.handed.get(path) != key):
+                    self.handed[path] = key
+                    ready.append(path)
+        for path in list(self.seen):
+            if path not in present:
+                del self.seen[path]
+                self.handed.pop(path, None)
+        return sorted(ready)
+
+    def skip_existing(self):
+        """Marks the files that are there now as handled, so poll only returns
+        new files (and files that change later, like an acquisition that was
+        still running).
+        """
+        now = time.monotonic()
+        for folder in self.folders:
+            for (path, size, mtime) in self.scan(folder, self.depth):
+                self.seen[path] = (size, mtime, now)
+                self.handed[path] = (size, mtime)
+
+    def forget(self, path):
+        """Makes "path" come back from a later poll (e.g. after a failed copy).
+        """
+        self.handed.pop(path, None)